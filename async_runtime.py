@@ -0,0 +1,203 @@
+"""
+Asyncio bot runtime (BOT_RUNTIME=asyncio).
+
+One event loop owns all Telegram network I/O: long polling for updates
+(or updates pushed to the webhook route) and delivery of the outbound
+queue. Handlers stay synchronous and run on a fixed pool of worker
+threads, so the number of threads no longer grows with the number of
+in-flight updates; conversations are only entries in ``user_states``.
+A full update queue pauses long polling, and makes the webhook route
+answer 503 just like the threaded ingestor.
+
+Handlers do not wait for storage I/O on their thread. Their durable
+writes are journaled and the handler returns at once; the update then
+awaits the group commit on the event loop, and only after that are the
+replies it queued released to the outbound queue. A worker thread is
+busy for the in-memory part of an update only, so up to ``max_queue``
+updates can be waiting on disk at the same time whatever ``workers`` is.
+Backends whose writes are durable when they return (SQLite) still do
+their disk I/O on the worker thread.
+"""
+
+import asyncio
+import logging
+import queue
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from webhook import UpdateIngestor
+
+logger = logging.getLogger(__name__)
+
+
+class AsyncBotRuntime(UpdateIngestor):
+    """Update intake, handler dispatch and outbound delivery on one event loop.
+
+    ``process`` handles one raw update on a worker thread, ``send`` is a
+    coroutine function delivering one OutboundMessage of ``outbound``,
+    ``storage`` defers the durability waits of the handlers and the
+    optional ``close`` coroutine function releases HTTP sessions on stop.
+    """
+
+    def __init__(self, process, outbound, send, storage, close=None, workers=8, max_queue=1000,
+                 dedupe_size=10000, durable_timeout=10):
+        super().__init__(process, workers=workers, max_queue=max_queue, dedupe_size=dedupe_size)
+        self.outbound = outbound
+        self.send = send
+        self.storage = storage
+        self.close = close
+        self.durable_timeout = durable_timeout
+        self.loop = None
+        self._task = None
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='handler')
+        self._pending = None  # asyncio.Queue, created on the loop
+        self._space = None
+        self._settling = None  # asyncio.Semaphore bounding updates waiting on disk
+        self._settles = set()
+        self._depth = 0
+        self._running = threading.Event()
+
+    # Producer side
+    def _enqueue(self, payload):
+        """Hand an update to the loop from any thread (hold _lock)"""
+        if self.loop is None or self._depth >= self.max_queue:
+            raise queue.Full
+        self._depth += 1
+        self.loop.call_soon_threadsafe(self._pending.put_nowait, payload)
+
+    async def _put(self, payload):
+        """Queue an update from the loop, waiting while the queue is full"""
+        while self._depth >= self.max_queue:
+            self._space.clear()
+            await self._space.wait()
+        with self._lock:
+            self._depth += 1
+        self._pending.put_nowait(payload)
+
+    async def poll(self, get_updates, timeout=60):
+        """Long-poll Telegram; get_updates(offset, timeout) is a coroutine returning raw updates"""
+        offset = None
+        backoff = 1
+        while True:
+            try:
+                updates = await get_updates(offset=offset, timeout=timeout)
+            except Exception as e:
+                logger.error(f"Polling error: {e}, retrying in {backoff}s")
+                await asyncio.sleep(backoff)
+                backoff = min(backoff * 2, 30)
+                continue
+            backoff = 1
+            for payload in updates:
+                offset = payload['update_id'] + 1
+                await self._put(payload)
+                self.accepted += 1
+
+    # Consumer side
+    def _handle(self, payload):
+        """Run the handlers for one update on a worker thread.
+
+        Returns the journal ticket their writes need (None if nothing is
+        pending) and the replies they queued, held back until it is durable.
+        """
+        replies = []
+        with self.storage.deferred_durability() as tickets, self.outbound.holding(replies):
+            try:
+                self.process(payload)
+                self.processed += 1
+            except Exception as e:
+                self.errors += 1
+                logger.error(f"Error processing update: {e}")
+        return (max(tickets) if tickets else None), replies
+
+    async def _settle(self, ticket, replies):
+        """Release an update's replies once the writes they acknowledge are durable"""
+        loop = self.loop
+        try:
+            durable = loop.create_future()
+            self.storage.on_durable(ticket, lambda: loop.call_soon_threadsafe(_resolve, durable))
+            await asyncio.wait_for(durable, self.durable_timeout)
+            self.outbound.release(replies)
+        except asyncio.TimeoutError:
+            self.errors += 1
+            logger.error(f"Journal commit #{ticket} not durable after {self.durable_timeout}s, "
+                         f"dropping {len(replies)} replies")
+        finally:
+            self._settling.release()
+            self._pending.task_done()
+
+    async def _work(self):
+        while True:
+            payload = await self._pending.get()
+            with self._lock:
+                self._depth -= 1
+            self._space.set()
+            await self._settling.acquire()
+            ticket, replies = await self.loop.run_in_executor(self._executor, self._handle, payload)
+            if ticket is None:
+                self.outbound.release(replies)
+                self._settling.release()
+                self._pending.task_done()
+            else:
+                # Wait for the disk on the loop, so this worker takes the next update now
+                task = self.loop.create_task(self._settle(ticket, replies))
+                self._settles.add(task)
+                task.add_done_callback(self._settles.discard)
+
+    async def _main(self, get_updates):
+        self.loop = asyncio.get_running_loop()
+        self._task = asyncio.current_task()
+        self._pending = asyncio.Queue()
+        self._space = asyncio.Event()
+        self._settling = asyncio.Semaphore(self.max_queue)
+        self._running.set()
+        tasks = [self._work() for _ in range(self.workers)]
+        tasks.append(self.outbound.run_async(self.send))
+        if get_updates is not None:
+            tasks.append(self.poll(get_updates))
+        try:
+            await asyncio.gather(*tasks)
+        finally:
+            if self.close is not None:
+                await self.close()
+            self._running.clear()
+            self.loop = None
+
+    def run(self, get_updates=None):
+        """Run the event loop in this thread, long polling when get_updates is given"""
+        try:
+            asyncio.run(self._main(get_updates))
+        except asyncio.CancelledError:
+            logger.info("Asyncio runtime stopped")
+
+    def start(self):
+        """Run the event loop on a background thread (webhook mode)"""
+        if self._running.is_set():
+            return
+        thread = threading.Thread(target=self.run, name='asyncio-runtime', daemon=True)
+        thread.start()
+        self._running.wait(5)
+        self._threads.append(thread)
+
+    def stop(self, timeout=5):
+        """Deliver what the outbound queue can send within timeout, then stop the loop"""
+        self.outbound.stop(timeout)
+        loop = self.loop
+        if loop is not None:
+            loop.call_soon_threadsafe(self._task.cancel)
+        for thread in self._threads:
+            thread.join(timeout=1)
+        self._threads = []
+
+    # Introspection
+    def join(self):
+        """Wait until every queued update is processed"""
+        asyncio.run_coroutine_threadsafe(self._pending.join(), self.loop).result()
+
+    def queue_depth(self):
+        return self._depth
+
+
+def _resolve(future):
+    """Complete a future unless it was already cancelled (e.g. timed out)"""
+    if not future.done():
+        future.set_result(None)
@@ -0,0 +1,506 @@
+#!/usr/bin/env python3
+"""
+Benchmark Script for Telegram Bot
+Runs main.py offline against a local stub of the Telegram Bot API and
+reports update throughput, handler latency, API latency, save_data() cost
+and memory per user at several user counts. With --startup it instead
+measures cold starts: state load time, time to the first handled message
+and peak RSS, from a legacy JSON snapshot and from the binary user segment.
+
+No network access is needed: the bot talks to the stub on 127.0.0.1 and
+all state lives in a temporary directory.
+
+Usage:
+    python benchmark.py
+    python benchmark.py --backend sqlite --users 10000,100000
+    python benchmark.py --runtime asyncio --telegram-latency-ms 50
+    python benchmark.py --json results.json
+    python benchmark.py --startup --users 100000,1000000
+"""
+
+import argparse
+import gc
+import itertools
+import json
+import logging
+import os
+import random
+import resource
+import sys
+import tempfile
+import threading
+import time
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+import requests
+
+BENCH_TOKEN = "1234567890:AAbenchmarkbenchmarkbenchmarkbench"
+ADMIN_ID = 1
+FIRST_USER_ID = 100000000
+
+
+# ✅ FAKE TELEGRAM API
+class FakeTelegramAPI(BaseHTTPRequestHandler):
+    """Answers Bot API calls like Telegram would, without sending anything"""
+
+    latency = 0.0
+    calls = defaultdict(int)
+    lock = threading.Lock()
+    message_ids = itertools.count(1)
+
+    def do_GET(self):
+        self._answer()
+
+    def do_POST(self):
+        self._answer()
+
+    def _answer(self):
+        parsed = urlparse(self.path)
+        method = parsed.path.rsplit('/', 1)[-1]
+        params = {k: v[0] for k, v in parse_qs(parsed.query).items()}
+        length = int(self.headers.get('Content-Length') or 0)
+        if length:
+            body = self.rfile.read(length).decode('utf-8', 'replace')
+            params.update({k: v[0] for k, v in parse_qs(body).items()})
+
+        with FakeTelegramAPI.lock:
+            FakeTelegramAPI.calls[method] += 1
+        if self.latency:
+            time.sleep(self.latency)
+
+        if method == 'getMe':
+            result = {'id': 1, 'is_bot': True, 'first_name': 'Benchmark', 'username': 'benchmark_bot'}
+        elif method in ('sendMessage', 'editMessageText'):
+            result = {
+                'message_id': next(FakeTelegramAPI.message_ids),
+                'date': int(time.time()),
+                'chat': {'id': int(params.get('chat_id', 0)), 'type': 'private'},
+                'text': params.get('text', '')
+            }
+        else:
+            result = True
+
+        payload = json.dumps({'ok': True, 'result': result}).encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload)
+
+    def log_message(self, *args):
+        pass
+
+
+def start_fake_telegram(latency_ms):
+    """Serve the fake Bot API on a free local port"""
+    FakeTelegramAPI.latency = latency_ms / 1000
+    server = ThreadingHTTPServer(('127.0.0.1', 0), FakeTelegramAPI)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+# ✅ HELPERS
+def percentile(values, fraction):
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(fraction * (len(ordered) - 1) + 0.5))]
+
+
+def latency_summary(values):
+    return {
+        'count': len(values),
+        'p50_ms': round(percentile(values, 0.50) * 1000, 3),
+        'p99_ms': round(percentile(values, 0.99) * 1000, 3),
+        'max_ms': round(max(values) * 1000, 3) if values else 0.0
+    }
+
+
+def rss_bytes():
+    """Current resident set size (peak RSS where /proc is unavailable)"""
+    try:
+        with open('/proc/self/status', 'r') as f:
+            for line in f:
+                if line.startswith('VmRSS:'):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak if sys.platform == 'darwin' else peak * 1024
+
+
+def make_update(update_ids, user_id, text):
+    """Synthetic Telegram update carrying one private text message"""
+    update_id = next(update_ids)
+    return {
+        'update_id': update_id,
+        'message': {
+            'message_id': update_id,
+            'date': int(time.time()),
+            'text': text,
+            'chat': {'id': user_id, 'type': 'private'},
+            'from': {'id': user_id, 'is_bot': False, 'first_name': 'Bench', 'username': f'bench{user_id}'}
+        }
+    }
+
+
+# One user's session: (kind, text). Referral codes and withdrawals exercise the write paths.
+SESSION = (
+    ('start', '/start {referrer}'),
+    ('balance', '💰 Balance'),
+    ('tasks', '🎯 Task'),
+    ('invite', '👥 Referral'),
+    ('withdraw', '💸 Withdraw'),
+    ('process_withdraw', 'Amount: 10\nUPI ID: bench@upi\nName: Bench User'),
+    ('balance', '💰 Balance')
+)
+
+
+# ✅ BENCHMARK PHASES
+def populate(main, start, end, chunk=10000):
+    """Create users start..end-1 with a balance, in bulk"""
+    for first in range(start, end, chunk):
+        main.storage.add_balances([(FIRST_USER_ID + i, 1.0) for i in range(first, min(end, first + chunk))])
+
+
+def measure_save(main, mutations, round_no):
+    """Cost of a full snapshot, then of an incremental save after some changes"""
+    start = time.perf_counter()
+    main.save_data(compact=True)
+    full_seconds = time.perf_counter() - start
+    full_bytes = main.storage.last_flush_bytes
+
+    for i in range(mutations):
+        main.storage.mark_task_completed(FIRST_USER_ID + i, f'bench_task_{round_no}')
+
+    start = time.perf_counter()
+    main.save_data()
+    delta_seconds = time.perf_counter() - start
+    return {
+        'delta_ms': round(delta_seconds * 1000, 2),
+        'delta_bytes': main.storage.last_flush_bytes,
+        'full_ms': round(full_seconds * 1000, 2),
+        'full_bytes': full_bytes
+    }
+
+
+def run_updates(main, users, concurrency, first_user_id, update_ids):
+    """Feed synthetic sessions through the bot handlers.
+
+    Each user's session runs in order on one worker (conversation state
+    depends on it); different users run concurrently.
+    """
+    user_ids = [first_user_id + i for i in range(users)]
+    # Enough balance for the withdrawal step
+    main.storage.add_balances([(user_id, 50.0) for user_id in user_ids])
+
+    latencies = defaultdict(list)
+    lock = threading.Lock()
+
+    def run_session(user_id):
+        referrer = random.choice(user_ids)
+        local = []
+        for kind, text in SESSION:
+            payload = make_update(update_ids, user_id, text.format(referrer=referrer))
+            start = time.perf_counter()
+            main.process_update_payload(payload)
+            local.append((kind, time.perf_counter() - start))
+        with lock:
+            for kind, seconds in local:
+                latencies[kind].append(seconds)
+
+    sent_before = FakeTelegramAPI.calls['sendMessage']
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        list(pool.map(run_session, user_ids))
+    elapsed = time.perf_counter() - start
+
+    # Replies are queued; measure how long the outbound queue takes to drain
+    main.outbound.flush(timeout=60)
+    drained = time.perf_counter() - start
+    sent = FakeTelegramAPI.calls['sendMessage'] - sent_before
+
+    all_latencies = [s for values in latencies.values() for s in values]
+    return {
+        'updates': len(all_latencies),
+        'updates_per_second': round(len(all_latencies) / elapsed, 1),
+        'latency': latency_summary(all_latencies),
+        'handlers': {kind: latency_summary(values) for kind, values in sorted(latencies.items())},
+        'messages_sent': sent,
+        'messages_per_second': round(sent / drained, 1) if drained else 0.0
+    }
+
+
+def run_api(base_url, api_key, requests_total, concurrency, user_range):
+    """Hit the /api/* routes concurrently over real HTTP"""
+    low, high = user_range
+    local = threading.local()
+    counter = itertools.count()
+
+    def one_request(_):
+        session = getattr(local, 'session', None)
+        if session is None:
+            session = local.session = requests.Session()
+        n = next(counter)
+        user_id = random.randint(low, high - 1)
+        kind = ('addbalance', 'checkbalance', 'userinfo', 'addbalance_idempotent', 'addbalance_bulk')[n % 5]
+        if kind == 'addbalance':
+            path, body = '/api/addbalance', {'user_id': user_id, 'amount': 1}
+        elif kind == 'addbalance_idempotent':
+            # Keys repeat, as retries do; a key always carries the same credit
+            key = n % 1000
+            path = '/api/addbalance'
+            body = {'user_id': low + key % (high - low), 'amount': 1, 'idempotency_key': f'bench-{key}'}
+        elif kind == 'addbalance_bulk':
+            path = '/api/addbalance/bulk'
+            body = {'items': [{'user_id': random.randint(low, high - 1), 'amount': 1} for _ in range(100)]}
+        else:
+            path, body = f'/api/{kind}', {'user_id': user_id}
+        body['api_key'] = api_key
+        start = time.perf_counter()
+        response = session.post(base_url + path, json=body, timeout=30)
+        return kind, time.perf_counter() - start, response.status_code
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        results = list(pool.map(one_request, range(requests_total)))
+    elapsed = time.perf_counter() - start
+
+    by_kind = defaultdict(list)
+    errors = 0
+    for kind, seconds, status in results:
+        by_kind[kind].append(seconds)
+        if status != 200:
+            errors += 1
+    return {
+        'requests': len(results),
+        'requests_per_second': round(len(results) / elapsed, 1),
+        'errors': errors,
+        'latency': latency_summary([seconds for _, seconds, _ in results]),
+        'routes': {kind: latency_summary(values) for kind, values in sorted(by_kind.items())}
+    }
+
+
+def write_legacy_snapshot(path, users):
+    """bot_data.json of the pre-segment layout, with users inline"""
+    task_ids = [f'bench_task_{i}' for i in range(8)]
+    data = {
+        'user_balances': {str(FIRST_USER_ID + i): float(i % 100) for i in range(users)},
+        'referral_data': {str(FIRST_USER_ID + i): FIRST_USER_ID + i // 10 for i in range(1, users, 3)},
+        'completed_tasks': {str(FIRST_USER_ID + i): task_ids[:i % 5] for i in range(0, users, 2)},
+        'banned_users': list(range(FIRST_USER_ID, FIRST_USER_ID + users, 1000)),
+        'task_sections': {}
+    }
+    with open(path, 'w', encoding='utf-8') as f:
+        json.dump(data, f)
+
+
+def startup_child(compact):
+    """Cold start in this process: import main, handle one message, report"""
+    started = time.monotonic()
+    telegram = start_fake_telegram(0)
+    import telebot.apihelper
+    telebot.apihelper.API_URL = f"http://127.0.0.1:{telegram.server_port}/bot{{0}}/{{1}}"
+    logging.basicConfig(level=logging.WARNING, format='%(levelname)s %(name)s: %(message)s')
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+    import main as bot_main
+    loaded = time.monotonic() - started
+    bot_main.process_update_payload(make_update(itertools.count(1), FIRST_USER_ID, '💰 Balance'))
+    first_message = time.monotonic() - started
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    result = {
+        'load_s': round(loaded, 3),
+        'first_message_s': round(first_message, 3),
+        'peak_rss_mb': round((peak if sys.platform == 'darwin' else peak * 1024) / 1024 / 1024, 1),
+        'users': bot_main.storage.user_count()
+    }
+    if compact:
+        # Leaves the split snapshot behind for the next cold start
+        bot_main.save_data(compact=True)
+    bot_main.outbound.stop()
+    bot_main.storage.close()
+    print(json.dumps(result))
+
+
+def run_startup(tiers, workdir):
+    """Cold starts per tier: legacy snapshot first, then the user segment"""
+    import subprocess
+    results = []
+    for tier in tiers:
+        tier_dir = os.path.join(workdir, f'startup-{tier}')
+        os.makedirs(tier_dir, exist_ok=True)
+        write_legacy_snapshot(os.path.join(tier_dir, 'bot_data.json'), tier)
+        result = {'users': tier}
+        for layout, compact in (('legacy_json', True), ('user_segment', False)):
+            output = subprocess.run(
+                [sys.executable, os.path.abspath(__file__), '--startup-child'] + (['--compact'] if compact else []),
+                cwd=tier_dir, env=os.environ, check=True, capture_output=True, text=True
+            ).stdout
+            result[layout] = json.loads(output.strip().splitlines()[-1])
+        results.append(result)
+        print(f"\n👥 {tier:,} users")
+        print("-" * 60)
+        for layout in ('legacy_json', 'user_segment'):
+            r = result[layout]
+            print(f"   {layout:<14} load {r['load_s']:>7} s   first message {r['first_message_s']:>7} s   "
+                  f"peak RSS {r['peak_rss_mb']:>7} MB")
+    return results
+
+
+def start_api_server(app):
+    """Serve the Flask app on a free local port with a threaded server"""
+    from werkzeug.serving import make_server
+    server = make_server('127.0.0.1', 0, app, threaded=True)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return f"http://127.0.0.1:{server.server_port}"
+
+
+def print_tier(result):
+    print(f"\n👥 {result['users']:,} users ({result['backend']} storage)")
+    print("-" * 60)
+    memory = result['memory']
+    table = f", user table {memory['table_bytes_per_user']} bytes/user" if memory['table_bytes_per_user'] else ''
+    print(f"Memory: {memory['rss_mb']} MB RSS, {memory['bytes_per_user']} bytes/user{table}")
+    save = result['save']
+    print(f"save_data(): delta {save['delta_ms']} ms / {save['delta_bytes']:,} bytes, "
+          f"full {save['full_ms']} ms / {save['full_bytes']:,} bytes")
+
+    updates = result['updates']
+    print(f"Updates: {updates['updates_per_second']} updates/s, "
+          f"p50 {updates['latency']['p50_ms']} ms, p99 {updates['latency']['p99_ms']} ms")
+    for kind, summary in updates['handlers'].items():
+        print(f"   {kind:<18} p50 {summary['p50_ms']:>8} ms   p99 {summary['p99_ms']:>8} ms")
+    print(f"Outbound: {updates['messages_sent']} messages, {updates['messages_per_second']} msg/s")
+
+    api = result['api']
+    print(f"API: {api['requests_per_second']} req/s, errors {api['errors']}, "
+          f"p50 {api['latency']['p50_ms']} ms, p99 {api['latency']['p99_ms']} ms")
+    for kind, summary in api['routes'].items():
+        print(f"   {kind:<22} p50 {summary['p50_ms']:>8} ms   p99 {summary['p99_ms']:>8} ms")
+
+
+def main():
+    """Main benchmark function"""
+    parser = argparse.ArgumentParser(description="Offline benchmark against a fake Telegram API")
+    parser.add_argument('--backend', choices=('json', 'sqlite'), default='json', help="storage backend (default json)")
+    parser.add_argument('--runtime', choices=('threads', 'asyncio'), default='threads', help="bot runtime (default threads)")
+    parser.add_argument('--users', default='10000,100000,1000000', help="comma-separated user counts to measure")
+    parser.add_argument('--sessions', type=int, default=500, help=f"synthetic user sessions per tier ({len(SESSION)} updates each)")
+    parser.add_argument('--api-requests', type=int, default=2000, help="API requests per tier")
+    parser.add_argument('--concurrency', type=int, default=16, help="concurrent update workers and API clients")
+    parser.add_argument('--save-mutations', type=int, default=1000, help="records changed before timing save_data()")
+    parser.add_argument('--telegram-latency-ms', type=float, default=0.0, help="simulated Bot API round trip")
+    parser.add_argument('--workdir', help="directory for bot state (default: a fresh temp dir)")
+    parser.add_argument('--json', dest='json_file', help="also write results to this JSON file")
+    parser.add_argument('--startup', action='store_true', help="measure cold start time and peak RSS instead")
+    parser.add_argument('--startup-child', action='store_true', help=argparse.SUPPRESS)
+    parser.add_argument('--compact', action='store_true', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.startup_child:
+        startup_child(args.compact)
+        return
+
+    tiers = sorted(int(x) for x in args.users.split(',') if x.strip())
+    json_file = os.path.abspath(args.json_file) if args.json_file else None
+    workdir = args.workdir or tempfile.mkdtemp(prefix='bot-benchmark-')
+    os.makedirs(workdir, exist_ok=True)
+
+    # Configure logging before main does, so only warnings reach the console
+    logging.basicConfig(level=logging.WARNING, format='%(levelname)s %(name)s: %(message)s')
+    logging.getLogger('werkzeug').setLevel(logging.WARNING)
+
+    telegram = start_fake_telegram(args.telegram_latency_ms)
+    import telebot.apihelper
+    telebot.apihelper.API_URL = f"http://127.0.0.1:{telegram.server_port}/bot{{0}}/{{1}}"
+    if args.runtime == 'asyncio':
+        import telebot.asyncio_helper
+        telebot.asyncio_helper.API_URL = telebot.apihelper.API_URL
+
+    os.environ.update({
+        'BOT_TOKEN': BENCH_TOKEN,
+        'ADMIN_ID': str(ADMIN_ID),
+        'API_SECRET_KEY': 'benchmark-key',
+        'STORAGE_BACKEND': args.backend,
+        'BOT_RUNTIME': args.runtime,
+        'RUN_MODE': 'all',
+        # Handlers run synchronously in the caller's thread, like webhook workers
+        'BOT_MODE': 'webhook',
+        'WEBHOOK_SECRET': 'benchmark-secret',
+        # Measure our own overhead, not Telegram's rate limits
+        'OUTBOUND_GLOBAL_RATE': '1000000',
+        'OUTBOUND_PER_CHAT_RATE': '1000000',
+    })
+    os.chdir(workdir)
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+    print("📊 Telegram Bot Benchmark")
+    print(f"⏰ Time: {time.strftime('%Y-%m-%d %H:%M:%S')}")
+    print(f"📁 Work dir: {workdir}")
+
+    if args.startup:
+        results = run_startup(tiers, workdir)
+        if json_file:
+            with open(json_file, 'w', encoding='utf-8') as f:
+                json.dump(results, f, indent=2)
+            print(f"💾 Results written to {json_file}")
+        return
+
+    import main as bot_main
+    bot_main.get_bot_username()
+    if args.runtime == 'asyncio':
+        # Event loop that delivers the outbound queue
+        bot_main.update_ingestor.start()
+    base_url = start_api_server(bot_main.app)
+    gc.collect()
+    baseline_rss = rss_bytes()
+
+    update_ids = itertools.count(1)
+    results = []
+    populated = 0
+    session_user_id = FIRST_USER_ID + tiers[-1] + 1
+
+    for tier in tiers:
+        populate(bot_main, populated, tier)
+        populated = tier
+        gc.collect()
+        rss = rss_bytes()
+        result = {
+            'backend': args.backend,
+            'users': tier,
+            'memory': {
+                'rss_mb': round(rss / 1024 / 1024, 1),
+                'bytes_per_user': round((rss - baseline_rss) / tier),
+                'table_bytes_per_user': (round(bot_main.storage.users.memory_bytes() / tier)
+                                         if args.backend == 'json' else None)
+            },
+            'save': measure_save(bot_main, min(args.save_mutations, tier), len(results)),
+            'updates': run_updates(bot_main, args.sessions, args.concurrency, session_user_id, update_ids),
+            'api': run_api(base_url, 'benchmark-key', args.api_requests, args.concurrency,
+                           (FIRST_USER_ID, FIRST_USER_ID + tier))
+        }
+        session_user_id += args.sessions
+        results.append(result)
+        print_tier(result)
+
+    print("-" * 60)
+    print(f"Fake Telegram API calls: {dict(FakeTelegramAPI.calls)}")
+    if json_file:
+        with open(json_file, 'w', encoding='utf-8') as f:
+            json.dump(results, f, indent=2)
+        print(f"💾 Results written to {json_file}")
+
+    if args.runtime == 'asyncio':
+        bot_main.update_ingestor.stop()
+    else:
+        bot_main.outbound.stop()
+    bot_main.storage.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,215 @@
+"""
+Resumable broadcast to every user.
+
+Recipients are streamed from storage in user-id order, one chunk at a
+time, and sent by a pool of sender threads paced by a token bucket.
+With a ``global_limiter`` (the OutboundDispatcher), every send also takes
+a token from the bot-wide bucket, so broadcast and ordinary replies
+together never exceed the global rate.
+Progress is checkpointed to a JSON file after every chunk, so a restart
+continues after the last completed chunk instead of starting over.
+Delivery is at-least-once: users in the chunk that was in flight during
+a crash may receive the message twice.
+"""
+
+import json
+import logging
+import os
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor, wait
+
+from outbound import TokenBucket
+
+logger = logging.getLogger(__name__)
+
+
+class BroadcastJob:
+    """One broadcast run with its checkpointed state"""
+
+    def __init__(self, storage, send, state_file, text=None, parse_mode=None, state=None,
+                 rate=25.0, workers=32, chunk_size=500, max_attempts=3,
+                 classify_error=None, on_progress=None, progress_interval=30, global_limiter=None):
+        self.storage = storage
+        self.send = send
+        self.state_file = state_file
+        self.rate = rate
+        self.workers = workers
+        self.chunk_size = chunk_size
+        self.max_attempts = max_attempts
+        self.classify_error = classify_error or (lambda e: (False, None))
+        self.on_progress = on_progress
+        self.progress_interval = progress_interval
+        self.global_limiter = global_limiter
+
+        self.state = state or {
+            'job_id': str(uuid.uuid4())[:8],
+            'text': text,
+            'parse_mode': parse_mode,
+            'status': 'running',
+            'cursor': None,
+            'sent': 0,
+            'failed': 0,
+            'skipped': 0,
+            'total': storage.user_count(),
+            'elapsed': 0.0
+        }
+
+        self._lock = threading.Lock()
+        self._cancelled = threading.Event()
+        self._paused_until = 0.0
+        self._bucket = TokenBucket(rate, max(1.0, rate))
+        self._thread = None
+        self._run_started = None
+
+    @classmethod
+    def resume(cls, storage, send, state_file, **kwargs):
+        """Load an unfinished job from its checkpoint, or None"""
+        if not os.path.exists(state_file):
+            return None
+        try:
+            with open(state_file, 'r', encoding='utf-8') as f:
+                state = json.load(f)
+        except (OSError, json.JSONDecodeError) as e:
+            logger.error(f"Unreadable broadcast checkpoint {state_file}: {e}")
+            return None
+        if state.get('status') != 'running':
+            return None
+        return cls(storage, send, state_file, state=state, **kwargs)
+
+    # Control
+    def start(self):
+        self._thread = threading.Thread(target=self._run, name=f"broadcast-{self.state['job_id']}", daemon=True)
+        self._thread.start()
+        return self._thread
+
+    def cancel(self):
+        self._cancelled.set()
+
+    def is_running(self):
+        return self._thread is not None and self._thread.is_alive()
+
+    def join(self, timeout=None):
+        if self._thread is not None:
+            self._thread.join(timeout)
+
+    def stats(self):
+        """Progress counters plus throughput"""
+        with self._lock:
+            stats = dict(self.state)
+        stats.pop('text', None)
+        elapsed = stats['elapsed']
+        if self._run_started is not None and stats['status'] == 'running':
+            elapsed += time.monotonic() - self._run_started
+        done = stats['sent'] + stats['failed'] + stats['skipped']
+        stats['elapsed'] = round(elapsed, 1)
+        stats['processed'] = done
+        stats['per_second'] = round(done / elapsed, 1) if elapsed > 0 else 0.0
+        remaining = max(0, stats['total'] - done)
+        stats['eta_seconds'] = round(remaining / stats['per_second']) if stats['per_second'] else None
+        return stats
+
+    # Worker side
+    def _checkpoint(self):
+        with self._lock:
+            state = dict(self.state)
+        if self._run_started is not None:
+            state['elapsed'] = state['elapsed'] + time.monotonic() - self._run_started
+        temp_file = self.state_file + '.tmp'
+        with open(temp_file, 'w', encoding='utf-8') as f:
+            json.dump(state, f, ensure_ascii=False)
+        os.replace(temp_file, self.state_file)
+
+    def _acquire_token(self):
+        while not self._cancelled.is_set():
+            now = time.monotonic()
+            if self._paused_until > now:
+                time.sleep(self._paused_until - now)
+                continue
+            with self._lock:
+                delay = self._bucket.delay(now)
+                if delay <= 0 and self.global_limiter is not None:
+                    delay = self.global_limiter.take_global_token()
+                if delay <= 0:
+                    self._bucket.consume(now)
+                    return True
+            time.sleep(delay)
+        return False
+
+    def _count(self, field):
+        with self._lock:
+            self.state[field] += 1
+
+    def _send_one(self, user_id):
+        for attempt in range(1, self.max_attempts + 1):
+            try:
+                self.send(user_id, self.state['text'], self.state['parse_mode'])
+                self._count('sent')
+                return
+            except Exception as e:
+                retry, retry_after = self.classify_error(e)
+                if not retry or attempt == self.max_attempts:
+                    logger.debug(f"Broadcast to {user_id} failed: {e}")
+                    self._count('failed')
+                    return
+                if retry_after:
+                    # Flood control applies to the whole bot, so pause every sender
+                    self._paused_until = max(self._paused_until, time.monotonic() + retry_after)
+                    logger.warning(f"Broadcast rate limited, pausing {retry_after}s")
+                else:
+                    time.sleep(0.5 * 2 ** (attempt - 1))
+                if not self._acquire_token():
+                    return
+
+    def _run(self):
+        self._run_started = time.monotonic()
+        last_progress = self._run_started
+        logger.info(f"📢 Broadcast {self.state['job_id']} running from cursor {self.state['cursor']}")
+
+        try:
+            with ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix='broadcast-send') as pool:
+                while not self._cancelled.is_set():
+                    chunk = self.storage.user_ids_after(self.state['cursor'], self.chunk_size)
+                    if not chunk:
+                        break
+
+                    futures = []
+                    for user_id in chunk:
+                        if self.storage.is_banned(user_id):
+                            self._count('skipped')
+                            continue
+                        if not self._acquire_token():
+                            break
+                        futures.append(pool.submit(self._send_one, user_id))
+                    wait(futures)
+
+                    if self._cancelled.is_set():
+                        break
+                    with self._lock:
+                        self.state['cursor'] = chunk[-1]
+                    self._checkpoint()
+
+                    now = time.monotonic()
+                    if self.on_progress and now - last_progress >= self.progress_interval:
+                        last_progress = now
+                        self.on_progress(self)
+
+            with self._lock:
+                self.state['status'] = 'cancelled' if self._cancelled.is_set() else 'finished'
+        except Exception as e:
+            logger.error(f"Broadcast {self.state['job_id']} stopped: {e}")
+            with self._lock:
+                self.state['status'] = 'failed'
+        finally:
+            try:
+                self._checkpoint()
+            except OSError as e:
+                logger.error(f"Failed to write broadcast checkpoint: {e}")
+            with self._lock:
+                self.state['elapsed'] += time.monotonic() - self._run_started
+            self._run_started = None
+
+        logger.info(f"📢 Broadcast {self.state['job_id']} {self.state['status']}: {self.stats()}")
+        if self.on_progress:
+            self.on_progress(self)
@@ -0,0 +1,95 @@
+"""
+Per-user conversation state.
+
+A user enters a state (e.g. 'withdraw') when the bot asks them for input
+and leaves it once the reply is handled. Users who never reply must not
+stay resident forever, so every state expires after a TTL and the store
+holds at most max_users entries, evicting the least recently started
+conversation first. Expired entries are dropped lazily on lookup and
+swept from the oldest end whenever a state is set.
+"""
+
+import threading
+import time
+from collections import OrderedDict
+
+CLEARED = 'cleared'
+EXPIRED = 'expired'
+EVICTED = 'evicted'
+
+
+class ConversationStore:
+    """Bounded map of user id -> conversation state with TTL expiry"""
+
+    def __init__(self, ttl=900, max_users=100000, clock=time.monotonic):
+        self.ttl = ttl
+        self.max_users = max_users
+        self.clock = clock
+        # user_id -> (state, expires_at), least recently set first; with one
+        # TTL for everyone that is also soonest to expire first
+        self._states = OrderedDict()
+        self._lock = threading.Lock()
+        self.ended = {CLEARED: 0, EXPIRED: 0, EVICTED: 0}
+
+    def __len__(self):
+        return len(self._states)
+
+    def get(self, user_id):
+        """Current state of user_id, or None"""
+        # Lock-free fast path: most messages come from users without a state
+        entry = self._states.get(user_id)
+        if entry is None:
+            return None
+        if entry[1] > self.clock():
+            return entry[0]
+        with self._lock:
+            if self._states.get(user_id) is entry:
+                del self._states[user_id]
+                self.ended[EXPIRED] += 1
+        return None
+
+    def set(self, user_id, state):
+        """Put user_id into state, restarting its TTL"""
+        now = self.clock()
+        with self._lock:
+            self._states.pop(user_id, None)
+            self._states[user_id] = (state, now + self.ttl)
+            self._expire(now)
+            while len(self._states) > self.max_users:
+                self._states.popitem(last=False)
+                self.ended[EVICTED] += 1
+
+    def clear(self, user_id):
+        """End user_id's conversation, if any"""
+        with self._lock:
+            if self._states.pop(user_id, None) is not None:
+                self.ended[CLEARED] += 1
+
+    def sweep(self):
+        """Drop expired states now; returns the number of live ones"""
+        with self._lock:
+            self._expire(self.clock())
+            return len(self._states)
+
+    def _expire(self, now):
+        """Pop expired states from the oldest end (hold _lock)"""
+        states = self._states
+        while states:
+            user_id, (_, expires_at) = next(iter(states.items()))
+            if expires_at > now:
+                break
+            del states[user_id]
+            self.ended[EXPIRED] += 1
+
+    def counts(self):
+        """Live conversations per state"""
+        with self._lock:
+            self._expire(self.clock())
+            result = {}
+            for state, _ in self._states.values():
+                result[state] = result.get(state, 0) + 1
+            return result
+
+    def stats(self):
+        with self._lock:
+            return dict(self.ended, active=len(self._states))
@@ -0,0 +1,45 @@
+"""
+Gunicorn settings for the HTTP API process.
+
+    RUN_MODE=api STORAGE_BACKEND=sqlite gunicorn -c gunicorn.conf.py main:app
+
+Every worker imports main.py and opens its own SQLite connections, so
+workers share balances through the database. Run the bot update loop
+separately with RUN_MODE=bot python main.py.
+"""
+
+import multiprocessing
+import os
+import sys
+
+# This config only serves the API; the bot loop must not start in workers
+os.environ.setdefault('RUN_MODE', 'api')
+
+bind = f"0.0.0.0:{os.getenv('PORT', '5000')}"
+
+# Threaded workers: API handlers mostly wait on SQLite, so a few threads per
+# process keep latency flat without a worker per connection
+worker_class = 'gthread'
+workers = int(os.getenv('API_WORKERS', str(min(4, multiprocessing.cpu_count() * 2 + 1))))
+threads = int(os.getenv('API_THREADS', '8'))
+
+# Keep-alive lets partners reuse connections for bursts of credits
+keepalive = int(os.getenv('API_KEEPALIVE', '15'))
+timeout = int(os.getenv('API_TIMEOUT', '30'))
+graceful_timeout = 30
+backlog = int(os.getenv('API_BACKLOG', '2048'))
+
+# Recycle workers now and then to cap memory growth
+max_requests = int(os.getenv('API_MAX_REQUESTS', '10000'))
+max_requests_jitter = max_requests // 10
+
+accesslog = '-'
+errorlog = '-'
+loglevel = os.getenv('API_LOG_LEVEL', 'info')
+
+
+def worker_exit(server, worker):
+    """Deliver queued user notifications before a worker is recycled or stopped"""
+    main = sys.modules.get('main')
+    if main is not None:
+        main.outbound.stop()
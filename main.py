@@ -5,14 +5,28 @@ import time
 import uuid
 import threading
 import json
+import hmac
 import os
-from datetime import datetime, timedelta
+from datetime import datetime
 import pytz
 import logging
 import random
-from flask import Flask, request, jsonify
+import resource
+import string
+from flask import Flask, Response, g, request, jsonify
 from werkzeug.security import check_password_hash, generate_password_hash
 
+from telebot.apihelper import ApiTelegramException
+
+from async_runtime import AsyncBotRuntime
+from broadcast import BroadcastJob
+from conversations import ConversationStore
+from metrics import Registry, timed
+from outbound import OutboundDispatcher
+from persistence import PersistenceWorker
+from webhook import BUSY as WEBHOOK_BUSY, UpdateIngestor
+from storage import SNAPSHOT_CODECS, SNAPSHOT_FORMATS, JsonStorage, NotDurableError, SQLiteStorage
+
 # Configure logging for production
 logging.basicConfig(
     level=logging.INFO, 
@@ -24,6 +38,9 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
+# Startup milestones (state loaded, first message) are measured from here
+STARTED_AT = time.monotonic()
+
 # ✅ BOT CONFIG - Use environment variables for security
 BOT_TOKEN = os.getenv('BOT_TOKEN')
 ADMIN_ID = int(os.getenv('ADMIN_ID', '0'))
@@ -47,22 +64,89 @@ if ADMIN_ID == 0:
         logger.error("ADMIN_ID environment variable is required!")
         raise ValueError("ADMIN_ID environment variable is required!")
 
+# ✅ PROCESS ROLE
+# "all" (default): bot and API in one process.
+# "bot": only the bot update loop (plus /webhook and /health in webhook mode).
+# "api": only the HTTP API, served by gunicorn: gunicorn -c gunicorn.conf.py main:app
+RUN_MODE = os.getenv('RUN_MODE', 'all').lower()
+if RUN_MODE not in ('all', 'bot', 'api'):
+    logger.error(f"Unknown RUN_MODE '{RUN_MODE}'")
+    raise ValueError(f"RUN_MODE must be all, bot or api, not '{RUN_MODE}'")
+
+# ✅ UPDATE INGESTION CONFIG
+# "polling" (default, good for local development) or "webhook"
+BOT_MODE = os.getenv('BOT_MODE', 'polling').lower()
+WEBHOOK_URL = os.getenv('WEBHOOK_URL', '')  # public base URL, e.g. https://your-app.onrender.com
+WEBHOOK_PATH = os.getenv('WEBHOOK_PATH', '/webhook')
+WEBHOOK_SECRET = os.getenv('WEBHOOK_SECRET', '')  # sent back by Telegram in X-Telegram-Bot-Api-Secret-Token
+WEBHOOK_WORKERS = int(os.getenv('WEBHOOK_WORKERS', '8'))
+WEBHOOK_QUEUE_SIZE = int(os.getenv('WEBHOOK_QUEUE_SIZE', '1000'))
+if BOT_MODE not in ('polling', 'webhook'):
+    logger.error(f"Unknown BOT_MODE '{BOT_MODE}'")
+    raise ValueError(f"BOT_MODE must be polling or webhook, not '{BOT_MODE}'")
+# The webhook route runs handlers as whoever the update claims to be, admin included
+if BOT_MODE == 'webhook' and RUN_MODE != 'api' and not WEBHOOK_SECRET:
+    logger.error("WEBHOOK_SECRET environment variable is required with BOT_MODE=webhook!")
+    raise ValueError("WEBHOOK_SECRET environment variable is required with BOT_MODE=webhook!")
+
+# "threads" (default): telebot worker threads and outbound sender threads.
+# "asyncio": one event loop for all Telegram I/O and journal durability waits,
+# handlers on a fixed thread pool.
+BOT_RUNTIME = os.getenv('BOT_RUNTIME', 'threads').lower()
+if BOT_RUNTIME not in ('threads', 'asyncio'):
+    logger.error(f"Unknown BOT_RUNTIME '{BOT_RUNTIME}'")
+    raise ValueError(f"BOT_RUNTIME must be threads or asyncio, not '{BOT_RUNTIME}'")
+
+if BOT_RUNTIME == 'asyncio':
+    # aiohttp is only needed by this runtime, so the import is deferred to here
+    from telebot import asyncio_helper
+    from telebot.async_telebot import AsyncTeleBot
+    TELEGRAM_API_ERRORS = (ApiTelegramException, asyncio_helper.ApiTelegramException)
+else:
+    TELEGRAM_API_ERRORS = (ApiTelegramException,)
+
 # ✅ FLASK API CONFIG
 app = Flask(__name__)
 API_SECRET_KEY = os.getenv('API_SECRET_KEY', 'your_secret_api_key_here_change_this')
 API_ENDPOINTS = {
     'add_balance': '/api/addbalance',
     'check_balance': '/api/checkbalance',
-    'user_info': '/api/userinfo'
+    'user_info': '/api/userinfo',
+    'add_balance_bulk': '/api/addbalance/bulk',
+    'check_balance_bulk': '/api/checkbalance/bulk',
+    'user_info_bulk': '/api/userinfo/bulk',
+    'withdrawals': '/api/withdrawals',
+    'withdrawals_process': '/api/withdrawals/process',
+    'stats': '/api/stats'
 }
 
+# Longest accepted Idempotency-Key for /api/addbalance
+IDEMPOTENCY_KEY_MAX_LENGTH = 255
+
+# Maximum number of items accepted by one bulk API request
+API_BULK_MAX_ITEMS = int(os.getenv('API_BULK_MAX_ITEMS', '1000'))
+
+@app.before_request
+def enforce_run_mode():
+    """Serve only the routes that belong to this process role"""
+    if RUN_MODE == 'bot' and request.path.startswith('/api/'):
+        return jsonify({'error': 'API is served by the api process'}), 404
+    if RUN_MODE == 'api' and request.path == WEBHOOK_PATH:
+        return jsonify({'error': 'Updates are handled by the bot process'}), 404
+    if BOT_MODE != 'webhook' and request.path == WEBHOOK_PATH:
+        return jsonify({'error': 'Webhook mode is not enabled'}), 404
+
 # Health check endpoint for Render
 @app.route('/health')
 def health_check():
     return jsonify({
         'status': 'healthy',
         'timestamp': datetime.now().isoformat(),
-        'bot_status': 'running' if BOT_USERNAME else 'initializing'
+        'bot_status': 'running' if BOT_USERNAME else 'initializing',
+        'bot_mode': BOT_MODE,
+        'run_mode': RUN_MODE,
+        'outbound_queue_depth': outbound.queue_depth(),
+        'webhook_queue_depth': update_ingestor.queue_depth()
     }), 200
 
 @app.route('/')
@@ -74,7 +158,10 @@ def home():
     })
 
 try:
-    bot = telebot.TeleBot(BOT_TOKEN)
+    # With webhooks or the asyncio runtime our own worker pool runs handlers, so telebot must not add another
+    bot = telebot.TeleBot(BOT_TOKEN, threaded=(BOT_MODE != 'webhook' and BOT_RUNTIME != 'asyncio'))
+    # Sends (and long polling) of the asyncio runtime
+    async_bot = AsyncTeleBot(BOT_TOKEN) if BOT_RUNTIME == 'asyncio' else None
     logger.info("Bot initialized successfully")
 except Exception as e:
     logger.error(f"Failed to initialize bot: {e}")
@@ -102,254 +189,188 @@ def get_local_time():
     local_time = datetime.now(indian_tz)
     return local_time.strftime("%Y-%m-%d %H:%M:%S")
 
-# ✅ DATA PERSISTENCE
-DATA_FILE = "bot_data.json"
-BACKUP_FILE = "bot_data_backup.json"
-
-def load_data():
-    """Load data from file with backup recovery"""
-    default_data = {
-        'user_balances': {},
-        'worked_users': {},
-        'pending_tasks': {},
-        'referral_data': {},
-        'banned_users': [],
-        'completed_tasks': {},
-        'task_sections': {
-            'watch_ads': [],
-            'app_downloads': [],
-            'promotional': []
-        },
-        'client_tasks': {},
-        'client_referrals': {},
-        'client_id_counter': 1,
-        'withdrawal_requests': {},
-        'task_tracking': {}
-    }
-
+# ✅ METRICS
+# Scraped from /metrics; set METRICS_TOKEN to require "Authorization: Bearer <token>"
+METRICS_TOKEN = os.getenv('METRICS_TOKEN', '')
+
+metrics = Registry()
+HANDLER_LATENCY = metrics.histogram(
+    'bot_handler_duration_seconds', 'Time spent in bot message handlers', ('handler',))
+SAVE_DURATION = metrics.histogram(
+    'bot_save_duration_seconds', 'Duration of save_data() calls', ('compact',))
+SAVE_BYTES = metrics.histogram(
+    'bot_save_bytes', 'Bytes written by one save_data() call',
+    buckets=(0, 1024, 16384, 131072, 1048576, 8388608, 67108864))
+SAVE_FAILURES = metrics.counter('bot_save_failures_total', 'save_data() calls that failed')
+SAVE_LAG = metrics.histogram(
+    'bot_save_lag_seconds', 'Seconds from a save request until a background save covered it')
+SAVE_BATCH = metrics.histogram(
+    'bot_save_coalesced_requests', 'Save requests covered by one background save',
+    buckets=(1, 2, 5, 10, 25, 50, 100, 250, 1000))
+API_LATENCY = metrics.histogram(
+    'bot_http_request_duration_seconds', 'HTTP request latency per route', ('route', 'method', 'status'))
+TELEGRAM_LATENCY = metrics.histogram(
+    'bot_telegram_request_duration_seconds', 'Bot API call latency', ('method',))
+TELEGRAM_ERRORS = metrics.counter(
+    'bot_telegram_errors_total', 'Failed Bot API calls', ('method', 'code'))
+LOCK_WAIT = metrics.histogram(
+    'bot_data_lock_wait_seconds', 'Time spent waiting for storage write locks',
+    buckets=(0.00001, 0.0001, 0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1.0, 5.0))
+
+STARTUP_SECONDS = metrics.gauge(
+    'bot_startup_seconds', 'Seconds from process start to each startup milestone', ('phase',))
+STARTUP_PEAK_RSS = metrics.gauge(
+    'bot_startup_peak_rss_bytes', 'Peak resident memory once the state was loaded')
+
+def peak_rss_bytes():
+    """Peak resident set size of this process so far (ru_maxrss is in KB on Linux)"""
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+def observe_lock_wait(seconds):
+    LOCK_WAIT.observe(seconds)
+
+def observe_telegram_error(method, error):
+    code = error.error_code if isinstance(error, TELEGRAM_API_ERRORS) else type(error).__name__
+    TELEGRAM_ERRORS.inc(method=method, code=code)
+
+def observe_telegram_call(method, func, *args, **kwargs):
+    """Run one Bot API call, recording its latency and any error"""
+    start = time.perf_counter()
     try:
-        if os.path.exists(DATA_FILE):
-            with open(DATA_FILE, 'r', encoding='utf-8') as f:
-                data = json.load(f)
-                # Ensure all required keys exist
-                for key in default_data:
-                    if key not in data:
-                        data[key] = default_data[key]
-                logger.info("Data loaded successfully from main file")
-                return data
-        elif os.path.exists(BACKUP_FILE):
-            logger.info("Loading from backup file...")
-            with open(BACKUP_FILE, 'r', encoding='utf-8') as f:
-                data = json.load(f)
-                # Ensure all required keys exist
-                for key in default_data:
-                    if key not in data:
-                        data[key] = default_data[key]
-                logger.info("Data loaded successfully from backup")
-                return data
-    except json.JSONDecodeError as e:
-        logger.error(f"JSON decode error: {e}")
-        if os.path.exists(BACKUP_FILE):
-            try:
-                with open(BACKUP_FILE, 'r', encoding='utf-8') as f:
-                    data = json.load(f)
-                    for key in default_data:
-                        if key not in data:
-                            data[key] = default_data[key]
-                    logger.info("Successfully loaded from backup after JSON error")
-                    return data
-            except Exception as backup_error:
-                logger.error(f"Backup loading failed: {backup_error}")
+        return func(*args, **kwargs)
     except Exception as e:
-        logger.error(f"Error loading data: {e}")
-        if os.path.exists(BACKUP_FILE):
-            try:
-                with open(BACKUP_FILE, 'r', encoding='utf-8') as f:
-                    data = json.load(f)
-                    for key in default_data:
-                        if key not in data:
-                            data[key] = default_data[key]
-                    logger.info("Successfully loaded from backup")
-                    return data
-            except Exception as backup_error:
-                logger.error(f"Backup loading failed: {backup_error}")
-
-    logger.warning("Using default data structure")
-    return default_data
-
-def save_data():
-    """Save data to file with enhanced backup and verification"""
-    try:
-        # Create backup before saving
-        if os.path.exists(DATA_FILE):
-            import shutil
-            try:
-                shutil.copy2(DATA_FILE, BACKUP_FILE)
-            except Exception as backup_error:
-                logger.warning(f"Failed to create backup: {backup_error}")
-
-        data = {
-            'user_balances': user_balances,
-            'worked_users': worked_users,
-            'pending_tasks': pending_tasks,
-            'referral_data': referral_data,
-            'banned_users': list(banned_users),
-            'completed_tasks': {str(k): list(v) if isinstance(v, set) else v for k, v in completed_tasks.items()},
-            'task_sections': task_sections,
-            'client_tasks': client_tasks,
-            'client_referrals': client_referrals,
-            'client_id_counter': client_id_counter,
-            'withdrawal_requests': withdrawal_requests,
-            'task_tracking': task_tracking if 'task_tracking' in globals() else {},
-            'save_timestamp': get_local_time(),
-            'data_integrity_check': len(user_balances)
-        }
-
-        # Atomic write with verification
-        temp_file = DATA_FILE + '.tmp'
-        with open(temp_file, 'w', encoding='utf-8') as f:
-            json.dump(data, f, ensure_ascii=False, indent=2)
-
-        # Verify written data
-        with open(temp_file, 'r', encoding='utf-8') as f:
-            verification_data = json.load(f)
-            if verification_data.get('data_integrity_check') != len(user_balances):
-                raise Exception("Data integrity check failed")
-
-        os.replace(temp_file, DATA_FILE)
-        logger.debug("Data saved successfully")
-        return True
+        observe_telegram_error(method, e)
+        raise
+    finally:
+        TELEGRAM_LATENCY.observe(time.perf_counter() - start, method=method)
 
+async def observe_telegram_call_async(method, func, *args, **kwargs):
+    """observe_telegram_call for a coroutine Bot API call"""
+    start = time.perf_counter()
+    try:
+        return await func(*args, **kwargs)
     except Exception as e:
-        logger.error(f"Error saving data: {e}")
-        # Clean up temp file if it exists
-        temp_file = DATA_FILE + '.tmp'
-        if os.path.exists(temp_file):
-            try:
-                os.remove(temp_file)
-            except:
-                pass
-
-        # Try to restore from backup if save fails
-        if os.path.exists(BACKUP_FILE):
-            try:
-                import shutil
-                shutil.copy2(BACKUP_FILE, DATA_FILE)
-                logger.info("Restored from backup after save failure")
-            except Exception as restore_error:
-                logger.error(f"Failed to restore from backup: {restore_error}")
-        return False
-
-# Load initial data
-try:
-    initial_data = load_data()
-
-    # Safe data conversion with error handling
-    user_balances = {}
-    for k, v in initial_data.get('user_balances', {}).items():
-        try:
-            user_balances[int(k)] = float(v)
-        except (ValueError, TypeError) as e:
-            logger.warning(f"Invalid user balance data: {k}={v}, error: {e}")
-
-    worked_users = initial_data.get('worked_users', {})
-    pending_tasks = initial_data.get('pending_tasks', {})
-
-    referral_data = {}
-    for k, v in initial_data.get('referral_data', {}).items():
-        try:
-            referral_data[int(k)] = int(v)
-        except (ValueError, TypeError) as e:
-            logger.warning(f"Invalid referral data: {k}={v}, error: {e}")
-
-    banned_users = set()
-    for x in initial_data.get('banned_users', []):
-        try:
-            banned_users.add(int(x))
-        except (ValueError, TypeError) as e:
-            logger.warning(f"Invalid banned user ID: {x}, error: {e}")
-
-    completed_tasks = {}
-    for k, v in initial_data.get('completed_tasks', {}).items():
-        try:
-            completed_tasks[int(k)] = set(v) if isinstance(v, list) else v
-        except (ValueError, TypeError) as e:
-            logger.warning(f"Invalid completed task data: {k}={v}, error: {e}")
-
-    task_sections = initial_data.get('task_sections', {
-        'watch_ads': [],
-        'app_downloads': [],
-        'promotional': []
-    })
-
-    # Ensure all required sections exist
-    for section in ['watch_ads', 'app_downloads', 'promotional']:
-        if section not in task_sections:
-            task_sections[section] = []
+        observe_telegram_error(method, e)
+        raise
+    finally:
+        TELEGRAM_LATENCY.observe(time.perf_counter() - start, method=method)
 
-    client_tasks = initial_data.get('client_tasks', {})
-    client_referrals = initial_data.get('client_referrals', {})
-    client_id_counter = initial_data.get('client_id_counter', 1)
-    withdrawal_requests = initial_data.get('withdrawal_requests', {})
-    task_tracking = initial_data.get('task_tracking', {})
+# ✅ DATA PERSISTENCE
+DATA_FILE = "bot_data.json"
+BACKUP_FILE = "bot_data_backup.json"
+JOURNAL_FILE = "bot_data.journal"
+
+# Storage backend: "json" (in-memory, default) or "sqlite" (on-disk, WAL mode)
+STORAGE_BACKEND = os.getenv('STORAGE_BACKEND', 'json').lower()
+SQLITE_FILE = os.getenv('SQLITE_FILE', 'bot_data.db')
+
+# Split bot/API processes share state through the database, never through memory
+if RUN_MODE != 'all' and STORAGE_BACKEND != 'sqlite':
+    logger.error(f"RUN_MODE={RUN_MODE} requires STORAGE_BACKEND=sqlite")
+    raise ValueError(f"RUN_MODE={RUN_MODE} requires STORAGE_BACKEND=sqlite")
+
+# Compact the delta journal into a fresh snapshot once it grows past this size
+JOURNAL_COMPACT_BYTES = int(os.getenv('JOURNAL_COMPACT_BYTES', str(8 * 1024 * 1024)))
+# How long the journal writer waits for more writers to join a group commit
+JOURNAL_COMMIT_WINDOW_MS = float(os.getenv('JOURNAL_COMMIT_WINDOW_MS', '2'))
+# Number of per-user write locks; users hashing to different stripes never contend
+STORAGE_LOCK_STRIPES = int(os.getenv('STORAGE_LOCK_STRIPES', '64'))
+# Snapshot encoding: "binary" (framed, checksummed, plus bot_data.users) or "json"
+# (the indented all-JSON layout older releases read); either one loads
+SNAPSHOT_FORMAT = os.getenv('SNAPSHOT_FORMAT', 'binary').lower()
+SNAPSHOT_COMPRESSION = os.getenv('SNAPSHOT_COMPRESSION', 'zlib').lower()
+
+# Idempotency keys of /api/addbalance are remembered this long, up to this many
+IDEMPOTENCY_TTL_HOURS = float(os.getenv('IDEMPOTENCY_TTL_HOURS', '24'))
+IDEMPOTENCY_MAX_KEYS = int(os.getenv('IDEMPOTENCY_MAX_KEYS', '100000'))
+
+def create_storage():
+    """Build the configured storage backend"""
+    if STORAGE_BACKEND == 'sqlite':
+        # An existing bot_data.json is imported on first start
+        return SQLiteStorage(
+            SQLITE_FILE, import_from=(DATA_FILE, BACKUP_FILE, JOURNAL_FILE),
+            idempotency_ttl=IDEMPOTENCY_TTL_HOURS * 3600,
+            idempotency_max_keys=IDEMPOTENCY_MAX_KEYS,
+            on_lock_wait=observe_lock_wait
+        )
+    if STORAGE_BACKEND != 'json':
+        logger.warning(f"Unknown STORAGE_BACKEND '{STORAGE_BACKEND}', using json")
+    snapshot_format, compression = SNAPSHOT_FORMAT, SNAPSHOT_COMPRESSION
+    if snapshot_format not in SNAPSHOT_FORMATS:
+        logger.warning(f"Unknown SNAPSHOT_FORMAT '{snapshot_format}', using binary")
+        snapshot_format = 'binary'
+    if compression not in SNAPSHOT_CODECS:
+        logger.warning(f"Unknown SNAPSHOT_COMPRESSION '{compression}', using zlib")
+        compression = 'zlib'
+    return JsonStorage(
+        DATA_FILE, BACKUP_FILE, JOURNAL_FILE,
+        compact_bytes=JOURNAL_COMPACT_BYTES,
+        commit_window=JOURNAL_COMMIT_WINDOW_MS / 1000,
+        clock=get_local_time,
+        idempotency_ttl=IDEMPOTENCY_TTL_HOURS * 3600,
+        idempotency_max_keys=IDEMPOTENCY_MAX_KEYS,
+        on_lock_wait=observe_lock_wait,
+        lock_stripes=STORAGE_LOCK_STRIPES,
+        snapshot_format=snapshot_format,
+        compression=compression
+    )
 
-    logger.info("Data initialization completed successfully")
+def save_data(compact=False):
+    """Persist pending changes through the storage backend"""
+    with SAVE_DURATION.time(compact=str(compact).lower()):
+        saved = storage.flush(compact=compact)
+    if saved:
+        SAVE_BYTES.observe(storage.last_flush_bytes)
+    else:
+        SAVE_FAILURES.inc()
+    return saved
 
-except Exception as e:
-    logger.error(f"Critical error during data initialization: {e}")
-    # Initialize with defaults
-    user_balances = {}
-    worked_users = {}
-    pending_tasks = {}
-    referral_data = {}
-    banned_users = set()
-    completed_tasks = {}
-    task_sections = {'watch_ads': [], 'app_downloads': [], 'promotional': []}
-    client_tasks = {}
-    client_referrals = {}
-    client_id_counter = 1
-    withdrawal_requests = {}
-    task_tracking = {}
+# Load initial data
+storage = create_storage()
+storage.load()
+STARTUP_SECONDS.set(time.monotonic() - STARTED_AT, phase='state_loaded')
+STARTUP_PEAK_RSS.set(peak_rss_bytes())
+logger.info(f"Using {storage.name} storage backend, state loaded in {time.monotonic() - STARTED_AT:.2f}s "
+            f"(peak RSS {peak_rss_bytes() / 1024 / 1024:.0f} MB)")
 
 # Remove admin ID from banned users if accidentally banned
-banned_users.discard(ADMIN_ID)
+if storage.is_banned(ADMIN_ID):
+    storage.set_banned(ADMIN_ID, False)
 
 # ✅ Runtime variables (not saved to disk)
-awaiting_withdraw = {}
-awaiting_message = {}
-awaiting_task_add = {}
-awaiting_support_message = {}
-awaiting_promotion_message = {}
-awaiting_client_data = {}
-awaiting_task_remove = {}
-awaiting_notice = {}
-awaiting_referral_reset = {}
+# Conversation state per user, e.g. 'withdraw'. One store replaces the old
+# awaiting_* dicts so routing needs a single lookup per message; states of
+# users who never reply expire, and the store never grows past its bound.
+CONVERSATION_TTL_SECONDS = float(os.getenv('CONVERSATION_TTL_SECONDS', '900'))
+CONVERSATION_MAX_USERS = int(os.getenv('CONVERSATION_MAX_USERS', '100000'))
+user_states = ConversationStore(ttl=CONVERSATION_TTL_SECONDS, max_users=CONVERSATION_MAX_USERS)
 
 # ✅ SECURITY SYSTEM - Bot Freeze/Unfreeze Feature
 bot_frozen = False
 freeze_timestamp = None
-awaiting_unlock_code = {}
 
 # Security codes (keep these secret!)
 FREEZE_CODE = "/stop2833"
 UNFREEZE_CODE = "/connect2833"
 
-# Auto-save with improved error handling and thread safety
-def auto_save():
-    save_count = 0
-    while True:
-        try:
-            time.sleep(30)  # Increased to 30 seconds to reduce I/O
-            if save_data():
-                save_count += 1
-                logger.info(f"✅ Auto-save completed (#{save_count})")
-            else:
-                logger.error("❌ Auto-save failed")
-        except KeyboardInterrupt:
-            logger.info("Auto-save thread interrupted")
-            break
-        except Exception as e:
-            logger.error(f"❌ Auto-save error: {e}")
+# ✅ BACKGROUND PERSISTENCE
+# Handlers only request a save; balances are already durable through the journal.
+# Requests within SAVE_DELAY_MS of each other share one save
+SAVE_DELAY_MS = float(os.getenv('SAVE_DELAY_MS', '200'))
+AUTO_SAVE_SECONDS = float(os.getenv('AUTO_SAVE_SECONDS', '30'))
+
+def observe_save_batch(requests, lag, ok):
+    SAVE_BATCH.observe(requests)
+    if ok:
+        SAVE_LAG.observe(lag)
+
+persistence = PersistenceWorker(
+    save_data,
+    delay=SAVE_DELAY_MS / 1000,
+    interval=AUTO_SAVE_SECONDS,
+    on_save=observe_save_batch
+)
 
 # Emoji rotation function
 def emoji_rotation_monitor():
@@ -357,31 +378,89 @@ def emoji_rotation_monitor():
     while True:
         try:
             time.sleep(3600)  # Check every hour
-            get_current_emoji('task')  # This will trigger rotation if 24 hours have passed
+            rotate_emojis_if_due()
         except KeyboardInterrupt:
             logger.info("Emoji rotation thread interrupted")
             break
         except Exception as e:
             logger.error(f"❌ Emoji rotation error: {e}")
 
-# Start auto-save thread
+# Start the background persistence worker
 try:
-    save_thread = threading.Thread(target=auto_save, daemon=True)
-    save_thread.start()
-    logger.info("Auto-save thread started")
+    persistence.start()
+    logger.info("Persistence worker started")
 except Exception as e:
-    logger.error(f"Failed to start auto-save thread: {e}")
+    logger.error(f"Failed to start persistence worker: {e}")
 
-# Start emoji rotation thread  
-try:
-    emoji_thread = threading.Thread(target=emoji_rotation_monitor, daemon=True)
-    emoji_thread.start()
-    logger.info("🎨 Emoji rotation thread started - 24-hour auto-update active")
-except Exception as e:
-    logger.error(f"Failed to start emoji rotation thread: {e}")
+# Start emoji rotation thread (API-only processes never render menus)
+if RUN_MODE != 'api':
+    try:
+        emoji_thread = threading.Thread(target=emoji_rotation_monitor, daemon=True)
+        emoji_thread.start()
+        logger.info("🎨 Emoji rotation thread started - 24-hour auto-update active")
+    except Exception as e:
+        logger.error(f"Failed to start emoji rotation thread: {e}")
+
+# ✅ OUTBOUND MESSAGE QUEUE
+# Telegram allows ~30 messages/s per bot and roughly 1 message/s per chat
+OUTBOUND_GLOBAL_RATE = float(os.getenv('OUTBOUND_GLOBAL_RATE', '30'))
+OUTBOUND_PER_CHAT_RATE = float(os.getenv('OUTBOUND_PER_CHAT_RATE', '1'))
+OUTBOUND_WORKERS = int(os.getenv('OUTBOUND_WORKERS', '8'))
+
+# Queued per chat like everything else, but called without a chat id argument
+CHATLESS_METHODS = frozenset({'answer_callback_query'})
+
+def outbound_args(message):
+    """Positional arguments of a queued Bot API call"""
+    if message.method in CHATLESS_METHODS:
+        return message.args
+    return (message.chat_id,) + message.args
+
+def deliver_outbound(message):
+    """Perform one queued Bot API call"""
+    return observe_telegram_call(
+        message.method, getattr(bot, message.method), *outbound_args(message), **message.kwargs)
+
+async def deliver_outbound_async(message):
+    """Perform one queued Bot API call on the asyncio runtime"""
+    return await observe_telegram_call_async(
+        message.method, getattr(async_bot, message.method), *outbound_args(message), **message.kwargs)
+
+def classify_send_error(error):
+    """Map a send failure to (retry, retry_after)"""
+    if isinstance(error, TELEGRAM_API_ERRORS):
+        if error.error_code == 429:
+            retry_after = (error.result_json or {}).get('parameters', {}).get('retry_after', 1)
+            return True, float(retry_after)
+        # 4xx other than 429 (blocked by user, chat not found, bad markup) will not succeed later
+        return error.error_code >= 500, None
+    # Network errors and timeouts
+    return True, None
+
+outbound = OutboundDispatcher(
+    deliver_outbound,
+    classify_error=classify_send_error,
+    global_rate=OUTBOUND_GLOBAL_RATE,
+    per_chat_rate=OUTBOUND_PER_CHAT_RATE,
+    workers=OUTBOUND_WORKERS
+)
+# The asyncio runtime delivers from its event loop instead of sender threads. API
+# processes never run that loop but still notify users (e.g. processed withdrawals),
+# so they always use sender threads; 429s from the shared bot limit are retried
+if RUN_MODE == 'api' or BOT_RUNTIME != 'asyncio':
+    outbound.start()
+
+def send_message(chat_id, text, coalesce_key=None, **kwargs):
+    """Queue a message for delivery and return immediately"""
+    return outbound.enqueue('send_message', chat_id, text, coalesce_key=coalesce_key, **kwargs)
 
-# Thread lock for data operations
-data_lock = threading.Lock()
+def reply_to(message, text, **kwargs):
+    """Queue a reply to a message"""
+    return send_message(message.chat.id, text, reply_to_message_id=message.message_id, **kwargs)
+
+def answer_callback(call, text=None):
+    """Queue the answer that stops the button's loading indicator"""
+    return outbound.enqueue('answer_callback_query', call.message.chat.id, call.id, text=text)
 
 # ✅ DYNAMIC EMOJI SYSTEM - Changes every 24 hours
 EMOJI_SETS = {
@@ -396,28 +475,79 @@ EMOJI_SETS = {
     'promotion': ['📢', '🎉', '🔥', '⚡', '💫', '🌟', '🎯', '💎', '🚀', '⭐']
 }
 
-# Emoji tracking
-last_emoji_change = datetime.now()
+# Emoji tracking: each 24-hour cycle is one epoch with its own emoji set
+EMOJI_ROTATION_SECONDS = 24 * 3600
 current_emoji_set = {}
+emoji_epoch = 0
+next_emoji_rotation = time.monotonic() + EMOJI_ROTATION_SECONDS
+emoji_lock = threading.Lock()
+
+def rotate_emojis_if_due():
+    """Start a new emoji epoch once 24 hours have passed, returns the current epoch"""
+    global current_emoji_set, emoji_epoch, next_emoji_rotation
+    if time.monotonic() >= next_emoji_rotation:
+        with emoji_lock:
+            if time.monotonic() >= next_emoji_rotation:
+                current_emoji_set = {}
+                emoji_epoch += 1
+                next_emoji_rotation = time.monotonic() + EMOJI_ROTATION_SECONDS
+                render_cache.clear()
+                logger.info("🎨 Emojis rotated! New 24-hour cycle started")
+    return emoji_epoch
 
 def get_current_emoji(category):
     """Get current emoji for a category with 24-hour rotation"""
-    global last_emoji_change, current_emoji_set
-    
-    # Check if 24 hours have passed
-    if datetime.now() - last_emoji_change > timedelta(hours=24):
-        current_emoji_set = {}
-        last_emoji_change = datetime.now()
-        logger.info("🎨 Emojis rotated! New 24-hour cycle started")
-    
-    # Get or set emoji for category
-    if category not in current_emoji_set:
-        if category in EMOJI_SETS:
-            current_emoji_set[category] = random.choice(EMOJI_SETS[category])
+    rotate_emojis_if_due()
+    emoji = current_emoji_set.get(category)
+    if emoji is None:
+        emoji = random.choice(EMOJI_SETS[category]) if category in EMOJI_SETS else '⭐'
+        # setdefault: concurrent first calls agree on one emoji
+        emoji = current_emoji_set.setdefault(category, emoji)
+    return emoji
+
+# ✅ RENDER CACHE
+# Keyboards and message templates only change when the emojis rotate, so they
+# are built once per emoji epoch and hot replies just fill in per-user values.
+render_cache = {}
+template_formatter = string.Formatter()
+
+def cached_render(name, build):
+    """build() for the current emoji epoch, computed once per rotation"""
+    key = (rotate_emojis_if_due(), name)
+    value = render_cache.get(key)
+    if value is None:
+        value = render_cache[key] = build()
+    return value
+
+def cached_keyboard(build):
+    """Pre-serialized reply_markup from a keyboard builder"""
+    return cached_render(build.__name__, lambda: build().to_json())
+
+def compile_template(template):
+    """Split a str.format template into (literal, field, spec) parts.
+
+    Fields named <category>_emoji are filled in now with the current emoji,
+    so only per-user fields are left for render_template.
+    """
+    parts = []
+    literal = ''
+    for text, field, spec, _ in template_formatter.parse(template):
+        literal += text
+        if field is None:
+            continue
+        if field.endswith('_emoji'):
+            literal += get_current_emoji(field[:-len('_emoji')])
         else:
-            current_emoji_set[category] = '⭐'  # Default
-    
-    return current_emoji_set[category]
+            parts.append((literal, field, spec))
+            literal = ''
+    parts.append((literal, None, ''))
+    return tuple(parts)
+
+def render_template(name, template, **values):
+    """Render a message template compiled for the current emoji epoch"""
+    parts = cached_render(name, lambda: compile_template(template))
+    return ''.join(literal if field is None else literal + format(values[field], spec)
+                   for literal, field, spec in parts)
 
 # ✅ UTILITY FUNCTIONS
 def is_admin(user_id):
@@ -426,7 +556,7 @@ def is_admin(user_id):
 
 def is_banned(user_id):
     """Check if user is banned"""
-    return user_id in banned_users
+    return storage.is_banned(user_id)
 
 def format_balance(amount):
     """Format balance with proper decimal places"""
@@ -446,41 +576,27 @@ def validate_amount(amount_str):
 
 def get_user_balance(user_id):
     """Get user balance safely"""
-    return user_balances.get(user_id, 0.0)
+    return storage.get_balance(user_id)
 
 def add_user_balance(user_id, amount):
     """Add amount to user balance"""
-    with data_lock:
-        current_balance = user_balances.get(user_id, 0.0)
-        user_balances[user_id] = current_balance + amount
-        return user_balances[user_id]
+    return storage.add_balance(user_id, amount)
 
 def deduct_user_balance(user_id, amount):
     """Deduct amount from user balance"""
-    with data_lock:
-        current_balance = user_balances.get(user_id, 0.0)
-        if current_balance >= amount:
-            user_balances[user_id] = current_balance - amount
-            return True, user_balances[user_id]
-        return False, current_balance
+    return storage.deduct_balance(user_id, amount)
 
 # ✅ REFERRAL SYSTEM
 def process_referral(referrer_id, referred_id):
     """Process referral bonus"""
     try:
-        if referrer_id != referred_id and referred_id not in referral_data:
-            referral_data[referred_id] = referrer_id
-            bonus = 5.0  # Referral bonus
-            add_user_balance(referrer_id, bonus)
-            
-            try:
-                bot.send_message(
-                    referrer_id,
-                    f"🎉 Congratulations! You earned ₹{bonus} referral bonus!\n"
-                    f"New user joined using your link."
-                )
-            except:
-                pass
+        bonus = 5.0  # Referral bonus
+        if referrer_id != referred_id and storage.credit_referral(referrer_id, referred_id, bonus) is not None:
+            send_message(
+                referrer_id,
+                f"🎉 Congratulations! You earned ₹{bonus} referral bonus!\n"
+                f"New user joined using your link."
+            )
             return True
     except Exception as e:
         logger.error(f"Error processing referral: {e}")
@@ -493,45 +609,37 @@ def generate_task_id():
 
 def add_task_to_section(section, task_data):
     """Add task to specific section"""
-    if section in task_sections:
-        task_data['id'] = generate_task_id()
-        task_data['created_at'] = get_local_time()
-        task_sections[section].append(task_data)
-        save_data()
+    task_data['id'] = generate_task_id()
+    task_data['created_at'] = get_local_time()
+    if storage.add_task(section, task_data):
+        persistence.flush()
         return task_data['id']
     return None
 
 def remove_task_from_section(section, task_id):
     """Remove task from section"""
-    if section in task_sections:
-        initial_count = len(task_sections[section])
-        task_sections[section] = [t for t in task_sections[section] if t.get('id') != task_id]
-        if len(task_sections[section]) < initial_count:
-            save_data()
-            return True
+    if storage.remove_task(section, task_id):
+        persistence.flush()
+        return True
     return False
 
-def get_available_tasks(user_id, section):
-    """Get available tasks for user in section"""
-    if section not in task_sections:
-        return []
-    
-    user_completed = completed_tasks.get(user_id, set())
-    available = []
-    
-    for task in task_sections[section]:
-        task_id = task.get('id')
-        if task_id and task_id not in user_completed:
-            available.append(task)
-    
-    return available
+# Tasks listed per page of a task section
+TASKS_PAGE_SIZE = 10
+
+TASK_SECTION_TITLES = {
+    'watch_ads': '📺 Watch Ads',
+    'app_downloads': '📱 App Downloads',
+    'promotional': '📢 Promotional'
+}
+
+def get_available_tasks(user_id, section, page=0):
+    """Get one page of available tasks for user in section, returns (tasks, total)"""
+    return storage.get_available_tasks(user_id, section, page * TASKS_PAGE_SIZE, TASKS_PAGE_SIZE)
 
 def mark_task_completed(user_id, task_id):
     """Mark task as completed for user"""
-    if user_id not in completed_tasks:
-        completed_tasks[user_id] = set()
-    completed_tasks[user_id].add(task_id)
-    save_data()
+    storage.mark_task_completed(user_id, task_id)
+    persistence.request()
 
 # ✅ KEYBOARD GENERATORS
 def create_main_keyboard():
@@ -582,7 +690,95 @@ def create_task_sections_keyboard():
 
 # ✅ BOT COMMAND HANDLERS
 
+# Message templates: {<category>_emoji} fields are filled once per emoji epoch
+WELCOME_TEMPLATE = """
+👋 Welcome {first_name}!
+
+{task_emoji} **Complete tasks and earn money!**
+{balance_emoji} **Current Balance:** ₹{balance:.2f}
+
+🎯 **Available Task Categories:**
+• 📺 Watch Ads
+• 📱 App Downloads  
+• 📢 Promotional Tasks
+
+💸 **Withdraw to UPI** when you have ₹10 or more
+👥 **Refer friends** and earn ₹5 per referral
+
+Use the menu below to get started!
+"""
+
+ADMIN_PANEL_TEMPLATE = """
+{admin_emoji} **ADMIN PANEL** {admin_emoji}
+
+**User Management:**
+• Add/Remove Tasks
+• Manage User Balances
+• View User Statistics
+• Process Withdrawals
+
+**Bot Controls:**
+• Broadcast Messages
+• Ban/Unban Users
+• Platform Statistics
+• Security Controls
+
+Choose an option from the menu below:
+"""
+
+BALANCE_TEMPLATE = """
+{balance_emoji} **Your Balance** {balance_emoji}
+
+💰 **Current Balance:** ₹{balance:.2f}
+
+{withdraw_status}
+
+📊 **Statistics:**
+• Total Tasks Completed: {completed_tasks}
+• Referrals Made: {referrals}
+
+💡 **Tip:** Complete more tasks or refer friends to increase your balance!
+"""
+
+TASKS_TEMPLATE = """
+{task_emoji} **Available Task Categories** {task_emoji}
+
+Choose a category to see available tasks:
+
+📺 **Watch Ads** - View advertisements and earn
+📱 **App Downloads** - Download and try apps
+📢 **Promotional** - Special promotional tasks
+
+Select a category below:
+"""
+
+INVITE_TEMPLATE = """
+{referral_emoji} **Invite Friends & Earn** {referral_emoji}
+
+🎁 **Referral Bonus:** ₹5 per friend
+👥 **Your Referrals:** {referral_count}
+💰 **Total Earned:** ₹{total_earned:.2f}
+
+🔗 **Your Referral Link:**
+`{referral_link}`
+
+📱 **Share this message:**
+💰 Join this amazing money earning bot! Complete simple tasks and earn real money. Use my referral link to get started: {referral_link}
+
+📋 **How it works:**
+1. Share your referral link
+2. When someone joins using your link
+3. You earn ₹5 bonus instantly!
+4. They can start earning too!
+
+💡 **Tips:**
+• Share in WhatsApp groups
+• Post on social media
+• Tell friends and family
+"""
+
 @bot.message_handler(commands=['start'])
+@timed(HANDLER_LATENCY, handler='start_command')
 def start_command(message):
     """Handle /start command"""
     user_id = message.from_user.id
@@ -591,12 +787,12 @@ def start_command(message):
     
     # Check if bot is frozen
     if bot_frozen and user_id != ADMIN_ID:
-        bot.reply_to(message, "🚫 Bot is temporarily frozen for maintenance. Please try again later.")
+        reply_to(message, "🚫 Bot is temporarily frozen for maintenance. Please try again later.")
         return
     
     # Check if user is banned
     if is_banned(user_id):
-        bot.reply_to(message, "🚫 You have been banned from using this bot.")
+        reply_to(message, "🚫 You have been banned from using this bot.")
         return
     
     # Process referral if present
@@ -609,38 +805,19 @@ def start_command(message):
         except ValueError:
             pass  # Invalid referral code
     
-    # Initialize user balance if new user
-    if user_id not in user_balances:
-        user_balances[user_id] = 0.0
-        save_data()
+    # Initialize user balance if new user (durable once ensure_user returns)
+    storage.ensure_user(user_id)
     
     # Get username for display
     bot_username = get_bot_username()
     
     # Welcome message with dynamic emojis
-    task_emoji = get_current_emoji('task')
-    balance_emoji = get_current_emoji('balance')
-    
-    welcome_text = f"""
-👋 Welcome {first_name}!
-
-{task_emoji} **Complete tasks and earn money!**
-{balance_emoji} **Current Balance:** ₹{format_balance(get_user_balance(user_id))}
-
-🎯 **Available Task Categories:**
-• 📺 Watch Ads
-• 📱 App Downloads  
-• 📢 Promotional Tasks
-
-💸 **Withdraw to UPI** when you have ₹10 or more
-👥 **Refer friends** and earn ₹5 per referral
-
-Use the menu below to get started!
-"""
+    welcome_text = render_template('welcome', WELCOME_TEMPLATE,
+                                   first_name=first_name, balance=get_user_balance(user_id))
     
-    bot.send_message(message.chat.id, welcome_text, 
-                    reply_markup=create_main_keyboard(), 
-                    parse_mode='Markdown')
+    send_message(message.chat.id, welcome_text, 
+                reply_markup=cached_keyboard(create_main_keyboard), 
+                parse_mode='Markdown')
 
 @bot.message_handler(commands=['admin'])
 def admin_command(message):
@@ -648,31 +825,14 @@ def admin_command(message):
     user_id = message.from_user.id
     
     if not is_admin(user_id):
-        bot.reply_to(message, "🚫 Access denied. Admin only.")
+        reply_to(message, "🚫 Access denied. Admin only.")
         return
     
-    admin_emoji = get_current_emoji('admin')
-    admin_text = f"""
-{admin_emoji} **ADMIN PANEL** {admin_emoji}
-
-**User Management:**
-• Add/Remove Tasks
-• Manage User Balances
-• View User Statistics
-• Process Withdrawals
-
-**Bot Controls:**
-• Broadcast Messages
-• Ban/Unban Users
-• Platform Statistics
-• Security Controls
-
-Choose an option from the menu below:
-"""
+    admin_text = render_template('admin_panel', ADMIN_PANEL_TEMPLATE)
     
-    bot.send_message(message.chat.id, admin_text, 
-                    reply_markup=create_admin_keyboard(), 
-                    parse_mode='Markdown')
+    send_message(message.chat.id, admin_text, 
+                reply_markup=cached_keyboard(create_admin_keyboard), 
+                parse_mode='Markdown')
 
 @bot.message_handler(commands=[FREEZE_CODE.replace('/', '')])
 def freeze_bot(message):
@@ -687,12 +847,12 @@ def freeze_bot(message):
     freeze_timestamp = get_local_time()
     
     admin_emoji = get_current_emoji('admin')
-    bot.send_message(message.chat.id, 
-                    f"{admin_emoji} **BOT FROZEN** {admin_emoji}\n\n"
-                    f"🚫 All operations suspended\n"
-                    f"⏰ Frozen at: {freeze_timestamp}\n\n"
-                    f"Use `{UNFREEZE_CODE}` to unfreeze", 
-                    parse_mode='Markdown')
+    send_message(message.chat.id, 
+                f"{admin_emoji} **BOT FROZEN** {admin_emoji}\n\n"
+                f"🚫 All operations suspended\n"
+                f"⏰ Frozen at: {freeze_timestamp}\n\n"
+                f"Use `{UNFREEZE_CODE}` to unfreeze", 
+                parse_mode='Markdown')
 
 @bot.message_handler(commands=[UNFREEZE_CODE.replace('/', '')])
 def unfreeze_bot(message):
@@ -707,104 +867,169 @@ def unfreeze_bot(message):
     unfreeze_time = get_local_time()
     
     admin_emoji = get_current_emoji('admin')
-    bot.send_message(message.chat.id, 
-                    f"{admin_emoji} **BOT UNFROZEN** {admin_emoji}\n\n"
-                    f"✅ All operations resumed\n"
-                    f"⏰ Unfrozen at: {unfreeze_time}\n"
-                    f"⏰ Was frozen at: {freeze_timestamp}", 
-                    parse_mode='Markdown')
+    send_message(message.chat.id, 
+                f"{admin_emoji} **BOT UNFROZEN** {admin_emoji}\n\n"
+                f"✅ All operations resumed\n"
+                f"⏰ Unfrozen at: {unfreeze_time}\n"
+                f"⏰ Was frozen at: {freeze_timestamp}", 
+                parse_mode='Markdown')
+
+@bot.message_handler(commands=['resetreferrals'])
+def reset_referrals_command(message):
+    """Reset all referrals made by a user: /resetreferrals <user_id>"""
+    user_id = message.from_user.id
+
+    if not is_admin(user_id):
+        return
+
+    parts = message.text.split()
+    if len(parts) < 2:
+        reply_to(message, "Usage: /resetreferrals <user_id>")
+        return
+
+    try:
+        referrer_id = int(parts[1])
+    except ValueError:
+        reply_to(message, "❌ Invalid user ID")
+        return
+
+    removed = storage.reset_referrals(referrer_id)
+    persistence.flush()
+
+    admin_emoji = get_current_emoji('admin')
+    send_message(message.chat.id,
+                f"{admin_emoji} **Referrals Reset**\n\n"
+                f"👤 User: `{referrer_id}`\n"
+                f"🗑️ Referrals removed: {removed}",
+                parse_mode='Markdown')
 
 # ✅ MAIN MESSAGE HANDLERS
 
-@bot.message_handler(func=lambda message: message.text and "Balance" in message.text)
+@timed(HANDLER_LATENCY, handler='balance_command')
 def balance_command(message):
     """Handle balance request"""
     user_id = message.from_user.id
     
     if bot_frozen and not is_admin(user_id):
-        bot.reply_to(message, "🚫 Bot is temporarily frozen for maintenance.")
+        reply_to(message, "🚫 Bot is temporarily frozen for maintenance.")
         return
     
     if is_banned(user_id):
-        bot.reply_to(message, "🚫 You have been banned from using this bot.")
+        reply_to(message, "🚫 You have been banned from using this bot.")
         return
     
-    balance = get_user_balance(user_id)
-    balance_emoji = get_current_emoji('balance')
+    summary = storage.get_user_summaries([user_id])[user_id]
+    balance = summary['balance']
     
-    balance_text = f"""
-{balance_emoji} **Your Balance** {balance_emoji}
-
-💰 **Current Balance:** ₹{format_balance(balance)}
-
-{'✅ **You can withdraw!**' if balance >= 10 else '❌ **Minimum ₹10 needed to withdraw**'}
-
-📊 **Statistics:**
-• Total Tasks Completed: {len(completed_tasks.get(user_id, set()))}
-• Referrals Made: {len([k for k, v in referral_data.items() if v == user_id])}
-
-💡 **Tip:** Complete more tasks or refer friends to increase your balance!
-"""
+    balance_text = render_template(
+        'balance', BALANCE_TEMPLATE,
+        balance=balance,
+        withdraw_status='✅ **You can withdraw!**' if balance >= 10 else '❌ **Minimum ₹10 needed to withdraw**',
+        completed_tasks=summary['completed_tasks'],
+        referrals=summary['referrals']
+    )
     
-    bot.send_message(message.chat.id, balance_text, parse_mode='Markdown')
+    send_message(message.chat.id, balance_text, parse_mode='Markdown', coalesce_key='balance')
 
-@bot.message_handler(func=lambda message: message.text and "Task" in message.text)
+@timed(HANDLER_LATENCY, handler='tasks_command')
 def tasks_command(message):
     """Handle tasks request"""
     user_id = message.from_user.id
     
     if bot_frozen and not is_admin(user_id):
-        bot.reply_to(message, "🚫 Bot is temporarily frozen for maintenance.")
+        reply_to(message, "🚫 Bot is temporarily frozen for maintenance.")
+        return
+    
+    if is_banned(user_id):
+        reply_to(message, "🚫 You have been banned from using this bot.")
+        return
+    
+    task_text = render_template('tasks', TASKS_TEMPLATE)
+    
+    send_message(message.chat.id, task_text, 
+                reply_markup=cached_keyboard(create_task_sections_keyboard), 
+                parse_mode='Markdown')
+
+def format_task(task):
+    """One line of a task list"""
+    line = f"• {task.get('title') or task.get('name') or 'Task ' + str(task.get('id'))}"
+    if task.get('reward') is not None:
+        try:
+            line += f" - ₹{format_balance(float(task['reward']))}"
+        except (TypeError, ValueError):
+            pass
+    link = task.get('link') or task.get('url')
+    if link:
+        line += f"\n  {link}"
+    return line
+
+@bot.callback_query_handler(func=lambda call: (call.data or '').startswith('section_'))
+@timed(HANDLER_LATENCY, handler='task_section_callback')
+def task_section_callback(call):
+    """Show a page of a task section: callback data section_<name> or section_<name>:<page>"""
+    user_id = call.from_user.id
+    answer_callback(call)
+    
+    if bot_frozen and not is_admin(user_id):
+        send_message(call.message.chat.id, "🚫 Bot is temporarily frozen for maintenance.")
         return
     
     if is_banned(user_id):
-        bot.reply_to(message, "🚫 You have been banned from using this bot.")
+        send_message(call.message.chat.id, "🚫 You have been banned from using this bot.")
+        return
+    
+    section, _, page = call.data[len('section_'):].partition(':')
+    if section not in TASK_SECTION_TITLES:
         return
+    page = int(page) if page.isdigit() else 0
     
+    tasks, total = get_available_tasks(user_id, section, page)
+    pages = max(1, (total + TASKS_PAGE_SIZE - 1) // TASKS_PAGE_SIZE)
     task_emoji = get_current_emoji('task')
     
-    task_text = f"""
-{task_emoji} **Available Task Categories** {task_emoji}
-
-Choose a category to see available tasks:
-
-📺 **Watch Ads** - View advertisements and earn
-📱 **App Downloads** - Download and try apps
-📢 **Promotional** - Special promotional tasks
-
-Select a category below:
-"""
+    if not tasks:
+        text = f"{task_emoji} {TASK_SECTION_TITLES[section]}\n\n✅ No tasks available right now. Check back later!"
+    else:
+        text = (f"{task_emoji} {TASK_SECTION_TITLES[section]} ({total} available, page {page + 1}/{pages})\n\n"
+                + "\n".join(format_task(task) for task in tasks))
     
-    bot.send_message(message.chat.id, task_text, 
-                    reply_markup=create_task_sections_keyboard(), 
-                    parse_mode='Markdown')
+    markup = None
+    if pages > 1:
+        markup = types.InlineKeyboardMarkup()
+        buttons = []
+        if page > 0:
+            buttons.append(types.InlineKeyboardButton("⬅️ Previous", callback_data=f"section_{section}:{page - 1}"))
+        if page + 1 < pages:
+            buttons.append(types.InlineKeyboardButton("Next ➡️", callback_data=f"section_{section}:{page + 1}"))
+        markup.row(*buttons)
+    
+    send_message(call.message.chat.id, text, reply_markup=markup)
 
-@bot.message_handler(func=lambda message: message.text and "Withdraw" in message.text)
 def withdraw_command(message):
     """Handle withdraw request"""
     user_id = message.from_user.id
     
     if bot_frozen and not is_admin(user_id):
-        bot.reply_to(message, "🚫 Bot is temporarily frozen for maintenance.")
+        reply_to(message, "🚫 Bot is temporarily frozen for maintenance.")
         return
     
     if is_banned(user_id):
-        bot.reply_to(message, "🚫 You have been banned from using this bot.")
+        reply_to(message, "🚫 You have been banned from using this bot.")
         return
     
     balance = get_user_balance(user_id)
     withdraw_emoji = get_current_emoji('withdraw')
     
     if balance < 10:
-        bot.send_message(message.chat.id, 
-                        f"{withdraw_emoji} **Withdrawal Not Available**\n\n"
-                        f"💰 Current Balance: ₹{format_balance(balance)}\n"
-                        f"❌ Minimum ₹10.00 required\n"
-                        f"💡 Complete more tasks to reach minimum!", 
-                        parse_mode='Markdown')
+        send_message(message.chat.id, 
+                    f"{withdraw_emoji} **Withdrawal Not Available**\n\n"
+                    f"💰 Current Balance: ₹{format_balance(balance)}\n"
+                    f"❌ Minimum ₹10.00 required\n"
+                    f"💡 Complete more tasks to reach minimum!", 
+                    parse_mode='Markdown')
         return
     
-    awaiting_withdraw[user_id] = True
+    set_user_state(user_id, 'withdraw')
     
     withdraw_text = f"""
 {withdraw_emoji} **Withdrawal Request** {withdraw_emoji}
@@ -832,9 +1057,9 @@ Name: John Doe
 Send your withdrawal request now:
 """
     
-    bot.send_message(message.chat.id, withdraw_text, parse_mode='Markdown')
+    send_message(message.chat.id, withdraw_text, parse_mode='Markdown')
 
-@bot.message_handler(func=lambda message: message.from_user.id in awaiting_withdraw and awaiting_withdraw[message.from_user.id])
+@timed(HANDLER_LATENCY, handler='process_withdraw')
 def process_withdraw(message):
     """Process withdrawal request"""
     user_id = message.from_user.id
@@ -855,28 +1080,23 @@ def process_withdraw(message):
         name = withdrawal_data.get('name', '')
         
         if not amount_str or not upi_id or not name:
-            bot.send_message(message.chat.id, 
-                           "❌ Invalid format. Please use the exact format shown above.")
+            send_message(message.chat.id, 
+                       "❌ Invalid format. Please use the exact format shown above.")
             return
         
         amount, error = validate_amount(amount_str)
         if error or amount is None:
-            bot.send_message(message.chat.id, f"❌ {error or 'Invalid amount'}")
+            send_message(message.chat.id, f"❌ {error or 'Invalid amount'}")
             return
         
         if amount < 10:
-            bot.send_message(message.chat.id, "❌ Minimum withdrawal amount is ₹10.00")
+            send_message(message.chat.id, "❌ Minimum withdrawal amount is ₹10.00")
             return
         
-        current_balance = get_user_balance(user_id)
-        if amount > current_balance:
-            bot.send_message(message.chat.id, 
-                           f"❌ Insufficient balance. Available: ₹{format_balance(current_balance)}")
-            return
-        
-        # Create withdrawal request
+        # Check, deduct and create the request in one step, so parallel credits
+        # or a double-submitted form can never overdraw the balance
         request_id = generate_task_id()
-        withdrawal_requests[request_id] = {
+        success, new_balance = storage.debit_withdrawal(user_id, amount, request_id, {
             'user_id': user_id,
             'amount': amount,
             'upi_id': upi_id,
@@ -884,103 +1104,582 @@ def process_withdraw(message):
             'status': 'pending',
             'created_at': get_local_time(),
             'username': message.from_user.username or 'Unknown'
-        }
-        
-        # Deduct balance
-        success, new_balance = deduct_user_balance(user_id, amount)
+        })
         if not success:
-            bot.send_message(message.chat.id, "❌ Error processing withdrawal. Please try again.")
-            del withdrawal_requests[request_id]
+            send_message(message.chat.id, 
+                       f"❌ Insufficient balance. Available: ₹{format_balance(new_balance)}")
             return
         
-        save_data()
-        awaiting_withdraw[user_id] = False
+        # The debit and the request were journaled together by debit_withdrawal
+        clear_user_state(user_id)
         
         withdraw_emoji = get_current_emoji('withdraw')
         
         # Confirmation to user
-        bot.send_message(message.chat.id, 
-                        f"{withdraw_emoji} **Withdrawal Request Submitted** {withdraw_emoji}\n\n"
-                        f"✅ Request ID: `{request_id}`\n"
-                        f"💰 Amount: ₹{format_balance(amount)}\n"
-                        f"💳 UPI ID: {upi_id}\n"
-                        f"👤 Name: {name}\n"
-                        f"💎 New Balance: ₹{format_balance(new_balance)}\n\n"
-                        f"⏰ Processing time: 24-48 hours\n"
-                        f"📞 Contact support if you have questions", 
-                        parse_mode='Markdown')
+        send_message(message.chat.id, 
+                    f"{withdraw_emoji} **Withdrawal Request Submitted** {withdraw_emoji}\n\n"
+                    f"✅ Request ID: `{request_id}`\n"
+                    f"💰 Amount: ₹{format_balance(amount)}\n"
+                    f"💳 UPI ID: {upi_id}\n"
+                    f"👤 Name: {name}\n"
+                    f"💎 New Balance: ₹{format_balance(new_balance)}\n\n"
+                    f"⏰ Processing time: 24-48 hours\n"
+                    f"📞 Contact support if you have questions", 
+                    parse_mode='Markdown')
         
         # Notify admin
-        try:
-            bot.send_message(ADMIN_ID, 
-                           f"💸 **New Withdrawal Request**\n\n"
-                           f"🆔 Request ID: `{request_id}`\n"
-                           f"👤 User: {message.from_user.first_name} (@{message.from_user.username or 'No username'})\n"
-                           f"💰 Amount: ₹{format_balance(amount)}\n"
-                           f"💳 UPI ID: {upi_id}\n"
-                           f"📝 Name: {name}\n"
-                           f"⏰ Time: {get_local_time()}", 
-                           parse_mode='Markdown')
-        except:
-            pass
+        send_message(ADMIN_ID, 
+                     f"💸 **New Withdrawal Request**\n\n"
+                     f"🆔 Request ID: `{request_id}`\n"
+                     f"👤 User: {message.from_user.first_name} (@{message.from_user.username or 'No username'})\n"
+                     f"💰 Amount: ₹{format_balance(amount)}\n"
+                     f"💳 UPI ID: {upi_id}\n"
+                     f"📝 Name: {name}\n"
+                     f"⏰ Time: {get_local_time()}", 
+                     parse_mode='Markdown')
     
     except Exception as e:
         logger.error(f"Error processing withdrawal: {e}")
-        bot.send_message(message.chat.id, 
-                        "❌ Error processing your request. Please try again.")
-        awaiting_withdraw[user_id] = False
+        send_message(message.chat.id, 
+                    "❌ Error processing your request. Please try again.")
+        clear_user_state(user_id)
 
-@bot.message_handler(func=lambda message: message.text and "Referral" in message.text)
+@timed(HANDLER_LATENCY, handler='invite_command')
 def invite_command(message):
     """Handle invite friends request"""
     user_id = message.from_user.id
     
     if bot_frozen and not is_admin(user_id):
-        bot.reply_to(message, "🚫 Bot is temporarily frozen for maintenance.")
+        reply_to(message, "🚫 Bot is temporarily frozen for maintenance.")
         return
     
     if is_banned(user_id):
-        bot.reply_to(message, "🚫 You have been banned from using this bot.")
+        reply_to(message, "🚫 You have been banned from using this bot.")
         return
     
     bot_username = get_bot_username()
     referral_link = f"https://t.me/{bot_username}?start={user_id}"
     
     # Calculate referral stats
-    referral_count = len([k for k, v in referral_data.items() if v == user_id])
+    referral_count = storage.count_referrals(user_id)
     total_earned = referral_count * 5.0  # ₹5 per referral
     
-    referral_emoji = get_current_emoji('referral')
+    invite_text = render_template('invite', INVITE_TEMPLATE, referral_count=referral_count,
+                                  total_earned=total_earned, referral_link=referral_link)
     
-    invite_text = f"""
-{referral_emoji} **Invite Friends & Earn** {referral_emoji}
+    send_message(message.chat.id, invite_text, parse_mode='Markdown')
+
+# ✅ WITHDRAWAL QUEUE
+WITHDRAWALS_PAGE_SIZE = 10
+WITHDRAWAL_STATUSES = ('pending', 'approved', 'rejected')
+
+def format_withdrawal(request_id, record):
+    """One line of the admin withdrawal list"""
+    return (f"• {request_id} - ₹{format_balance(float(record.get('amount', 0)))} "
+            f"- user {record.get('user_id')} - {record.get('status')}\n"
+            f"  {record.get('name', '')} / {record.get('upi_id', '')} - {record.get('created_at', '')}")
+
+def process_withdrawal_request(request_id, status):
+    """Approve or reject a pending withdrawal, returns the record or None if not pending"""
+    if status == 'rejected':
+        # The amount was debited when the request was made; the refund commits with the status
+        rejected = storage.reject_withdrawal(request_id, get_local_time())
+        if rejected is None:
+            return None
+        record, new_balance = rejected
+        text = (f"❌ Your withdrawal request `{request_id}` of ₹{format_balance(float(record.get('amount', 0)))} "
+                f"was rejected.\n"
+                f"💰 The amount has been returned to your balance: ₹{format_balance(new_balance)}")
+    else:
+        record = storage.set_withdrawal_status(request_id, status, get_local_time(), from_status='pending')
+        if record is None:
+            return None
+        text = (f"✅ Your withdrawal request `{request_id}` of ₹{format_balance(float(record.get('amount', 0)))} "
+                f"has been approved!")
+    send_message(record['user_id'], text, parse_mode='Markdown')
+    return record
+
+def show_withdrawals(chat_id, status, cursor=None):
+    """Send one page of the withdrawal queue, oldest first"""
+    items, next_cursor = storage.list_withdrawals(status=status, cursor=cursor, limit=WITHDRAWALS_PAGE_SIZE)
+    total = storage.count_withdrawals(status)
+    admin_emoji = get_current_emoji('admin')
+    title = f"{admin_emoji} Withdrawals: {status or 'all'} ({total})"
+    if not items:
+        text = f"{title}\n\n✅ Nothing here."
+    else:
+        text = f"{title}\n\n" + "\n".join(format_withdrawal(request_id, record) for request_id, record in items)
+        if status == 'pending':
+            text += "\n\nApprove with /approve <id>, reject and refund with /reject <id>"
 
-🎁 **Referral Bonus:** ₹5 per friend
-👥 **Your Referrals:** {referral_count}
-💰 **Total Earned:** ₹{format_balance(total_earned)}
+    markup = types.InlineKeyboardMarkup()
+    markup.row(*[types.InlineKeyboardButton(name.title(), callback_data=f"withdrawals_{name}")
+                 for name in WITHDRAWAL_STATUSES + ('all',)])
+    if next_cursor is not None:
+        markup.row(types.InlineKeyboardButton("Next ➡️", callback_data=f"withdrawals_{status or 'all'}:{next_cursor}"))
+
+    send_message(chat_id, text, reply_markup=markup)
+
+def withdrawals_command(message):
+    """Handle the admin Withdrawals button"""
+    show_withdrawals(message.chat.id, 'pending')
+
+@bot.callback_query_handler(func=lambda call: (call.data or '').startswith('withdrawals_'))
+def withdrawals_callback(call):
+    """Show a page of withdrawals: callback data withdrawals_<status> or withdrawals_<status>:<cursor>"""
+    answer_callback(call)
+    if not is_admin(call.from_user.id):
+        return
 
-🔗 **Your Referral Link:**
-`{referral_link}`
+    status, _, cursor = call.data[len('withdrawals_'):].partition(':')
+    if status != 'all' and status not in WITHDRAWAL_STATUSES:
+        return
+    try:
+        show_withdrawals(call.message.chat.id, None if status == 'all' else status, cursor or None)
+    except ValueError:
+        send_message(call.message.chat.id, "❌ This page is no longer available")
 
-📱 **Share this message:**
-💰 Join this amazing money earning bot! Complete simple tasks and earn real money. Use my referral link to get started: {referral_link}
+def withdrawal_decision_command(message, status):
+    """Handle /approve <request_id> and /reject <request_id>"""
+    if not is_admin(message.from_user.id):
+        return
 
-📋 **How it works:**
-1. Share your referral link
-2. When someone joins using your link
-3. You earn ₹5 bonus instantly!
-4. They can start earning too!
+    parts = message.text.split()
+    if len(parts) < 2:
+        reply_to(message, f"Usage: /{parts[0].lstrip('/')} <request_id>")
+        return
 
-💡 **Tips:**
-• Share in WhatsApp groups
-• Post on social media
-• Tell friends and family
-"""
-    
-    bot.send_message(message.chat.id, invite_text, parse_mode='Markdown')
+    request_id = parts[1]
+    record = process_withdrawal_request(request_id, status)
+    if record is None:
+        reply_to(message, f"❌ No pending withdrawal `{request_id}`", parse_mode='Markdown')
+        return
+
+    send_message(message.chat.id,
+                 f"{'✅' if status == 'approved' else '❌'} Withdrawal `{request_id}` {status}\n"
+                 f"👤 User: `{record['user_id']}`\n"
+                 f"💰 Amount: ₹{format_balance(float(record.get('amount', 0)))}\n"
+                 f"⏳ Still pending: {storage.count_withdrawals('pending')}",
+                 parse_mode='Markdown')
+
+@bot.message_handler(commands=['approve'])
+def approve_withdrawal_command(message):
+    """Approve a pending withdrawal: /approve <request_id>"""
+    withdrawal_decision_command(message, 'approved')
+
+@bot.message_handler(commands=['reject'])
+def reject_withdrawal_command(message):
+    """Reject a pending withdrawal and refund it: /reject <request_id>"""
+    withdrawal_decision_command(message, 'rejected')
+
+# ✅ PLATFORM STATS
+
+def get_platform_stats():
+    """Platform totals with amounts rounded for display"""
+    stats = storage.platform_stats()
+    withdrawals = {status: {'count': 0, 'amount': 0.0} for status in WITHDRAWAL_STATUSES}
+    for status, totals in stats['withdrawals'].items():
+        withdrawals[status] = {'count': totals['count'], 'amount': round(totals['amount'], 2)}
+    return dict(stats, balance_total=round(stats['balance_total'], 2), withdrawals=withdrawals)
+
+def platform_stats_command(message):
+    """Handle the admin Platform Stats button"""
+    stats = get_platform_stats()
+    withdrawals = stats['withdrawals']
+    admin_emoji = get_current_emoji('admin')
+    send_message(message.chat.id,
+                 f"{admin_emoji} **Platform Stats** {admin_emoji}\n\n"
+                 f"👥 Users: {stats['users']}\n"
+                 f"🚫 Banned: {stats['banned_users']}\n"
+                 f"💰 Balance liability: ₹{format_balance(stats['balance_total'])}\n"
+                 f"✅ Tasks completed: {stats['completed_tasks']}\n"
+                 f"🤝 Referrals: {stats['referrals']}\n\n"
+                 f"⏳ Pending withdrawals: {withdrawals['pending']['count']} "
+                 f"(₹{format_balance(withdrawals['pending']['amount'])})\n"
+                 f"✅ Approved: {withdrawals['approved']['count']} "
+                 f"(₹{format_balance(withdrawals['approved']['amount'])})\n"
+                 f"❌ Rejected: {withdrawals['rejected']['count']} "
+                 f"(₹{format_balance(withdrawals['rejected']['amount'])})\n\n"
+                 f"⏰ {get_local_time()}",
+                 parse_mode='Markdown', coalesce_key='platform_stats')
+
+# ✅ BROADCAST
+BROADCAST_STATE_FILE = "broadcast_state.json"
+# Broadcast sends also draw from the outbound queue's OUTBOUND_GLOBAL_RATE bucket,
+# so this only caps the broadcast's share; below the global rate it leaves
+# headroom for interactive replies. Raise both (with BROADCAST_WORKERS) when
+# paid broadcasts are enabled for the bot
+BROADCAST_RATE = float(os.getenv('BROADCAST_RATE', '25'))
+BROADCAST_WORKERS = int(os.getenv('BROADCAST_WORKERS', '32'))
+
+active_broadcast = None
+# Admin-written broadcast awaiting confirmation: {'id', 'text'}
+broadcast_draft = None
+
+def broadcast_send(user_id, text, parse_mode):
+    """Deliver one broadcast message directly (paced by the job and the outbound queue's global bucket)"""
+    observe_telegram_call('send_message', bot.send_message, user_id, text, parse_mode=parse_mode)
+
+def report_broadcast_progress(job):
+    """Send broadcast progress to the admin"""
+    stats = job.stats()
+    eta = f"{stats['eta_seconds']}s" if stats['eta_seconds'] is not None else "-"
+    send_message(ADMIN_ID,
+                 f"📢 Broadcast {stats['job_id']}: {stats['status']}\n\n"
+                 f"✅ Sent: {stats['sent']}\n"
+                 f"❌ Failed: {stats['failed']}\n"
+                 f"🚫 Skipped (banned): {stats['skipped']}\n"
+                 f"📊 Progress: {stats['processed']}/{stats['total']}\n"
+                 f"⚡ Rate: {stats['per_second']}/s\n"
+                 f"⏰ Elapsed: {stats['elapsed']}s, ETA: {eta}",
+                 coalesce_key='broadcast_progress')
+
+def build_broadcast_job(**kwargs):
+    """Common BroadcastJob settings"""
+    return dict(
+        rate=BROADCAST_RATE,
+        workers=BROADCAST_WORKERS,
+        classify_error=classify_send_error,
+        on_progress=report_broadcast_progress,
+        global_limiter=outbound,
+        **kwargs
+    )
+
+def start_broadcast(text):
+    """Start a broadcast unless one is already running"""
+    global active_broadcast
+    if active_broadcast is not None and active_broadcast.is_running():
+        return None
+    active_broadcast = BroadcastJob(storage, broadcast_send, BROADCAST_STATE_FILE,
+                                    **build_broadcast_job(text=text))
+    active_broadcast.start()
+    return active_broadcast
+
+def resume_broadcast():
+    """Continue a broadcast interrupted by a restart"""
+    global active_broadcast
+    job = BroadcastJob.resume(storage, broadcast_send, BROADCAST_STATE_FILE, **build_broadcast_job())
+    if job is not None:
+        logger.info(f"Resuming broadcast {job.state['job_id']} after user {job.state['cursor']}")
+        active_broadcast = job
+        job.start()
+
+def broadcast_command(message):
+    """Handle the admin Broadcast button"""
+    if active_broadcast is not None and active_broadcast.is_running():
+        report_broadcast_progress(active_broadcast)
+        return
+
+    set_user_state(message.from_user.id, 'broadcast')
+    send_message(message.chat.id,
+                 "📢 Send the message to broadcast to all users.\n"
+                 "Send /cancelbroadcast to abort.")
+
+def process_broadcast_message(message):
+    """Show the admin's next message as a preview awaiting confirmation"""
+    global broadcast_draft
+    clear_user_state(message.from_user.id)
+    broadcast_draft = {'id': generate_task_id(), 'text': message.text}
+
+    markup = types.InlineKeyboardMarkup()
+    markup.row(types.InlineKeyboardButton("✅ Yes, send", callback_data=f"broadcast_send:{broadcast_draft['id']}"),
+               types.InlineKeyboardButton("❌ No", callback_data=f"broadcast_discard:{broadcast_draft['id']}"))
+    send_message(message.chat.id,
+                 f"📢 Send this to ~{storage.user_count()} users?\n\n{message.text}",
+                 reply_markup=markup)
+
+@bot.callback_query_handler(func=lambda call: (call.data or '').startswith('broadcast_'))
+def broadcast_confirm_callback(call):
+    """Start or discard the previewed broadcast: callback data broadcast_send:<id> or broadcast_discard:<id>"""
+    global broadcast_draft
+    answer_callback(call)
+    if not is_admin(call.from_user.id):
+        return
+
+    action, _, draft_id = call.data[len('broadcast_'):].partition(':')
+    draft = broadcast_draft
+    # Buttons of an older preview must not send the current draft
+    if draft is None or draft['id'] != draft_id:
+        send_message(call.message.chat.id, "❌ This broadcast preview has expired.")
+        return
+    broadcast_draft = None
+
+    if action != 'send':
+        send_message(call.message.chat.id, "📢 Broadcast discarded, nothing was sent.")
+        return
+    job = start_broadcast(draft['text'])
+    if job is None:
+        send_message(call.message.chat.id, "❌ A broadcast is already running.")
+        return
+    send_message(call.message.chat.id,
+                 f"📢 Broadcast {job.state['job_id']} started to ~{job.state['total']} users.")
+
+@bot.message_handler(commands=['cancelbroadcast'])
+def cancel_broadcast_command(message):
+    """Cancel the running broadcast, a pending broadcast prompt or an unconfirmed preview"""
+    global broadcast_draft
+    if not is_admin(message.from_user.id):
+        return
+    clear_user_state(message.from_user.id)
+    broadcast_draft = None
+    if active_broadcast is not None and active_broadcast.is_running():
+        active_broadcast.cancel()
+        send_message(message.chat.id, "🛑 Cancelling broadcast...")
+    else:
+        send_message(message.chat.id, "No broadcast is running.")
+
+# ✅ MESSAGE ROUTING
+
+def set_user_state(user_id, state):
+    """Put a user into a conversation state that handles their next non-menu text"""
+    user_states.set(user_id, state)
+
+def clear_user_state(user_id):
+    """Return a user to normal menu routing"""
+    user_states.clear(user_id)
+
+# Every emoji a keyboard label can start with
+LABEL_EMOJIS = frozenset(e for emojis in EMOJI_SETS.values() for e in emojis) | {'🔙'}
+
+def normalize_label(text):
+    """Strip the rotating emoji prefix from a keyboard label"""
+    text = text.strip()
+    prefix, sep, rest = text.partition(' ')
+    if sep and prefix in LABEL_EMOJIS:
+        return rest.strip()
+    return text
+
+# Conversation state -> handler
+STATE_HANDLERS = {
+    'withdraw': process_withdraw,
+    'broadcast': process_broadcast_message
+}
+
+# Normalized keyboard label -> handler
+BUTTON_HANDLERS = {
+    'Task': tasks_command,
+    'Balance': balance_command,
+    'Withdraw': withdraw_command,
+    'Referral': invite_command
+}
+
+# Normalized admin keyboard label -> handler (admin only)
+ADMIN_BUTTON_HANDLERS = {
+    'Withdrawals': withdrawals_command,
+    'Platform Stats': platform_stats_command,
+    'Broadcast': broadcast_command
+}
+
+# Normalized label of every keyboard button, including those without a text handler
+MENU_LABELS = frozenset(BUTTON_HANDLERS) | frozenset(ADMIN_BUTTON_HANDLERS) | {
+    'Submit Proof', 'Support', 'User Info', 'Promotion',
+    'Add Task', 'Remove Task', 'Balance Mgmt', 'User Stats', 'Ban User', 'Bot Controls',
+    'Back to Main'
+}
+
+@bot.message_handler(func=lambda message: True)
+def route_text_message(message):
+    """Dispatch text messages: menu buttons first, then conversation state"""
+    if not message.text:
+        return
+
+    user_id = message.from_user.id
+    label = normalize_label(message.text)
+    if label in MENU_LABELS:
+        # Tapping a button abandons whatever the user was asked to type
+        if user_states.get(user_id) == 'broadcast':
+            send_message(message.chat.id, "📢 Broadcast cancelled, nothing was sent.")
+        clear_user_state(user_id)
+        handler = ADMIN_BUTTON_HANDLERS.get(label) if is_admin(user_id) else None
+        handler = handler or BUTTON_HANDLERS.get(label)
+        if handler is not None:
+            return handler(message)
+        return
+
+    state = user_states.get(user_id)
+    if state is not None:
+        handler = STATE_HANDLERS.get(state)
+        if handler is not None:
+            return handler(message)
+
+first_message_seen = False
+
+def observe_first_message(messages):
+    """Record the time to the first handled message after a start"""
+    global first_message_seen
+    if first_message_seen:
+        return
+    first_message_seen = True
+    elapsed = time.monotonic() - STARTED_AT
+    STARTUP_SECONDS.set(elapsed, phase='first_message')
+    logger.info(f"First message received {elapsed:.2f}s after start")
+
+# Telegram listeners see every batch of new messages before the handlers do
+bot.set_update_listener(observe_first_message)
+
+# ✅ WEBHOOK INGESTION
+
+def process_update_payload(payload):
+    """Run the bot handlers for one raw update"""
+    bot.process_new_updates([types.Update.de_json(payload)])
+
+if BOT_RUNTIME == 'asyncio':
+    # Also runs long polling and outbound delivery, see run_bot()
+    update_ingestor = AsyncBotRuntime(
+        process_update_payload,
+        outbound,
+        deliver_outbound_async,
+        storage,
+        close=async_bot.close_session,
+        workers=WEBHOOK_WORKERS,
+        max_queue=WEBHOOK_QUEUE_SIZE
+    )
+else:
+    update_ingestor = UpdateIngestor(
+        process_update_payload,
+        workers=WEBHOOK_WORKERS,
+        max_queue=WEBHOOK_QUEUE_SIZE
+    )
+
+async def fetch_updates_async(offset, timeout):
+    """Raw getUpdates long poll for the asyncio runtime"""
+    return await asyncio_helper.get_updates(BOT_TOKEN, offset=offset, timeout=timeout,
+                                            request_timeout=timeout + 10)
+
+@app.route(WEBHOOK_PATH, methods=['POST'])
+def telegram_webhook():
+    """Receive updates pushed by Telegram"""
+    token = request.headers.get('X-Telegram-Bot-Api-Secret-Token', '')
+    if not hmac.compare_digest(token.encode('utf-8'), WEBHOOK_SECRET.encode('utf-8')):
+        return jsonify({'error': 'Invalid secret token'}), 401
+
+    payload = request.get_json(silent=True)
+    if not isinstance(payload, dict):
+        return jsonify({'error': 'Invalid update'}), 400
+
+    result = update_ingestor.submit(payload.get('update_id'), payload)
+    if result == WEBHOOK_BUSY:
+        # Telegram redelivers after a failed response, which throttles the sender
+        return jsonify({'error': 'Busy, retry later'}), 503
+    return jsonify({'ok': True, 'result': result})
+
+def start_webhook():
+    """Start webhook workers and register the webhook with Telegram"""
+    update_ingestor.start()
+    if not WEBHOOK_URL:
+        logger.warning("WEBHOOK_URL not set; accepting updates locally without registering a webhook")
+        return
+    webhook_url = WEBHOOK_URL.rstrip('/') + WEBHOOK_PATH
+    bot.set_webhook(
+        url=webhook_url,
+        secret_token=WEBHOOK_SECRET,
+        max_connections=min(100, WEBHOOK_WORKERS * 5)
+    )
+    logger.info(f"Webhook registered at {webhook_url}")
+
+# ✅ METRICS ENDPOINT
+metrics.gauge('bot_records', 'Stored records per collection', ('collection',),
+              callback=lambda: storage.record_counts())
+metrics.gauge('bot_conversations_active', 'Users in the middle of a conversation', ('state',),
+              callback=lambda: user_states.counts())
+metrics.counter('bot_conversations_ended_total', 'Conversations ended, by how they ended', ('reason',),
+                callback=lambda: user_states.ended)
+metrics.gauge('bot_outbound_queue_depth', 'Messages waiting in the outbound queue',
+              callback=lambda: outbound.queue_depth())
+metrics.gauge('bot_webhook_queue_depth', 'Updates waiting for a webhook worker',
+              callback=lambda: update_ingestor.queue_depth())
+metrics.counter('bot_outbound_messages_total', 'Outbound queue outcomes', ('outcome',),
+                callback=lambda: {k: v for k, v in outbound.stats().items()
+                                  if k in ('sent', 'failed', 'retried', 'coalesced', 'dropped', 'rate_limited')})
+if storage.name == 'json':
+    metrics.counter('bot_journal_bytes_total', 'Bytes committed to the delta journal',
+                    callback=lambda: storage.journal.bytes_committed)
+    metrics.counter('bot_journal_commits_total', 'Group commits (fsyncs) of the delta journal',
+                    callback=lambda: storage.journal.commits)
+    metrics.gauge('bot_user_table_bytes', 'Approximate memory held by the in-memory user table',
+                  callback=lambda: storage.users.memory_bytes())
+
+@app.before_request
+def start_request_timer():
+    g.request_start = time.perf_counter()
+
+@app.after_request
+def observe_request(response):
+    start = getattr(g, 'request_start', None)
+    if start is not None:
+        # The URL rule, not the raw path, keeps label cardinality bounded
+        route = request.url_rule.rule if request.url_rule else 'unmatched'
+        API_LATENCY.observe(time.perf_counter() - start,
+                            route=route, method=request.method, status=response.status_code)
+    return response
+
+@app.route('/metrics')
+def metrics_endpoint():
+    """Prometheus scrape endpoint"""
+    if METRICS_TOKEN and request.headers.get('Authorization') != f'Bearer {METRICS_TOKEN}':
+        return jsonify({'error': 'Invalid metrics token'}), 401
+    return Response(metrics.render(), mimetype='text/plain; version=0.0.4')
 
 # ✅ FLASK API ENDPOINTS
 
+def parse_credit(user_id, amount):
+    """Validate a credit request, returns (user_id, amount, error)"""
+    if not user_id or not amount:
+        return None, None, 'user_id and amount required'
+    try:
+        user_id = int(user_id)
+        amount = float(amount)
+    except (ValueError, TypeError):
+        return None, None, 'Invalid user_id or amount format'
+    if amount <= 0:
+        return None, None, 'Amount must be positive'
+    return user_id, amount, None
+
+def add_balance_idempotent(key, user_id, amount):
+    """Credit once per idempotency key; retries get the original response"""
+    if len(key) > IDEMPOTENCY_KEY_MAX_LENGTH:
+        return jsonify({'error': f'Idempotency key longer than {IDEMPOTENCY_KEY_MAX_LENGTH} characters'}), 400
+    
+    # The credit and the key are committed together, so no save_data() is needed
+    record, replayed = storage.add_balance_once(key, user_id, amount, get_local_time())
+    if replayed and (record['user_id'] != user_id or record['amount'] != amount):
+        return jsonify({'error': 'Idempotency key already used with a different user_id or amount'}), 422
+    
+    response = jsonify({
+        'success': True,
+        'user_id': record['user_id'],
+        'amount_added': record['amount'],
+        'new_balance': record['new_balance'],
+        'timestamp': record['timestamp']
+    })
+    if replayed:
+        response.headers['Idempotent-Replayed'] = 'true'
+    return response
+
+def parse_user_id(user_id):
+    """Validate a user id, returns (user_id, error)"""
+    if not user_id:
+        return None, 'user_id required'
+    try:
+        return int(user_id), None
+    except (ValueError, TypeError):
+        return None, 'Invalid user_id format'
+
+def build_user_info(user_id, summary=None):
+    """User information returned by the user info endpoints"""
+    if summary is None:
+        summary = storage.get_user_summaries([user_id])[user_id]
+    return {'user_id': user_id, **summary}
+
+def get_bulk_list(data, field):
+    """Return the list in a bulk request body, or an (error, status) pair"""
+    items = data.get(field)
+    if not isinstance(items, list) or not items:
+        return None, (f'{field} must be a non-empty list', 400)
+    if len(items) > API_BULK_MAX_ITEMS:
+        return None, (f'At most {API_BULK_MAX_ITEMS} {field} per request', 413)
+    return items, None
+
 @app.route(API_ENDPOINTS['add_balance'], methods=['POST'])
 def api_add_balance():
     """API endpoint to add balance to user"""
@@ -991,24 +1690,17 @@ def api_add_balance():
         if data.get('api_key') != API_SECRET_KEY:
             return jsonify({'error': 'Invalid API key'}), 401
         
-        user_id = data.get('user_id')
-        amount = data.get('amount')
-        
-        if not user_id or not amount:
-            return jsonify({'error': 'user_id and amount required'}), 400
+        user_id, amount, error = parse_credit(data.get('user_id'), data.get('amount'))
+        if error:
+            return jsonify({'error': error}), 400
         
-        try:
-            user_id = int(user_id)
-            amount = float(amount)
-        except ValueError:
-            return jsonify({'error': 'Invalid user_id or amount format'}), 400
-        
-        if amount <= 0:
-            return jsonify({'error': 'Amount must be positive'}), 400
+        idempotency_key = request.headers.get('Idempotency-Key') or data.get('idempotency_key')
+        if idempotency_key:
+            return add_balance_idempotent(str(idempotency_key), user_id, amount)
         
         # Add balance
+        # Durable once add_user_balance returns (write-ahead journal)
         new_balance = add_user_balance(user_id, amount)
-        save_data()
         
         return jsonify({
             'success': True,
@@ -1018,6 +1710,10 @@ def api_add_balance():
             'timestamp': get_local_time()
         })
         
+    except NotDurableError as e:
+        # Not acknowledged: the journal is failing, so the change may or may not survive a crash
+        logger.error(f"API add_balance not durable: {e}")
+        return jsonify({'error': 'Change not saved, retry later'}), 503
     except Exception as e:
         logger.error(f"API add_balance error: {e}")
         return jsonify({'error': 'Internal server error'}), 500
@@ -1032,15 +1728,9 @@ def api_check_balance():
         if data.get('api_key') != API_SECRET_KEY:
             return jsonify({'error': 'Invalid API key'}), 401
         
-        user_id = data.get('user_id')
-        
-        if not user_id:
-            return jsonify({'error': 'user_id required'}), 400
-        
-        try:
-            user_id = int(user_id)
-        except ValueError:
-            return jsonify({'error': 'Invalid user_id format'}), 400
+        user_id, error = parse_user_id(data.get('user_id'))
+        if error:
+            return jsonify({'error': error}), 400
         
         balance = get_user_balance(user_id)
         
@@ -1065,58 +1755,302 @@ def api_user_info():
         if data.get('api_key') != API_SECRET_KEY:
             return jsonify({'error': 'Invalid API key'}), 401
         
-        user_id = data.get('user_id')
+        user_id, error = parse_user_id(data.get('user_id'))
+        if error:
+            return jsonify({'error': error}), 400
         
-        if not user_id:
-            return jsonify({'error': 'user_id required'}), 400
+        return jsonify({
+            'success': True,
+            **build_user_info(user_id),
+            'timestamp': get_local_time()
+        })
         
-        try:
-            user_id = int(user_id)
-        except ValueError:
-            return jsonify({'error': 'Invalid user_id format'}), 400
+    except Exception as e:
+        logger.error(f"API user_info error: {e}")
+        return jsonify({'error': 'Internal server error'}), 500
+
+@app.route(API_ENDPOINTS['add_balance_bulk'], methods=['POST'])
+def api_add_balance_bulk():
+    """API endpoint to credit many users in one atomic, durable batch"""
+    try:
+        data = request.get_json()
         
-        balance = get_user_balance(user_id)
-        completed_count = len(completed_tasks.get(user_id, set()))
-        referral_count = len([k for k, v in referral_data.items() if v == user_id])
+        # Validate API key
+        if data.get('api_key') != API_SECRET_KEY:
+            return jsonify({'error': 'Invalid API key'}), 401
+        
+        items, error = get_bulk_list(data, 'items')
+        if error:
+            return jsonify({'error': error[0]}), error[1]
+        
+        results = [None] * len(items)
+        credits = []
+        positions = []
+        for index, item in enumerate(items):
+            if not isinstance(item, dict):
+                results[index] = {'index': index, 'success': False, 'error': 'Item must be an object'}
+                continue
+            user_id, amount, item_error = parse_credit(item.get('user_id'), item.get('amount'))
+            if item_error:
+                results[index] = {'index': index, 'success': False, 'error': item_error}
+                continue
+            credits.append((user_id, amount))
+            positions.append(index)
+        
+        # One lock acquisition and one durable commit for every valid item
+        new_balances = storage.add_balances(credits) if credits else []
+        
+        for index, (user_id, amount), new_balance in zip(positions, credits, new_balances):
+            results[index] = {
+                'index': index,
+                'success': True,
+                'user_id': user_id,
+                'amount_added': amount,
+                'new_balance': new_balance
+            }
         
         return jsonify({
             'success': True,
-            'user_id': user_id,
-            'balance': balance,
-            'completed_tasks': completed_count,
-            'referrals': referral_count,
-            'is_banned': user_id in banned_users,
+            'applied': len(credits),
+            'failed': len(items) - len(credits),
+            'results': results,
             'timestamp': get_local_time()
         })
         
+    except NotDurableError as e:
+        # Not acknowledged: the journal is failing, so the change may or may not survive a crash
+        logger.error(f"API add_balance_bulk not durable: {e}")
+        return jsonify({'error': 'Change not saved, retry later'}), 503
     except Exception as e:
-        logger.error(f"API user_info error: {e}")
+        logger.error(f"API add_balance_bulk error: {e}")
         return jsonify({'error': 'Internal server error'}), 500
 
-# ✅ RUN APPLICATION
-if __name__ == "__main__":
+def parse_bulk_user_ids(items):
+    """Split raw user ids into valid ids and per-item error results"""
+    results = [None] * len(items)
+    valid = []
+    for index, raw in enumerate(items):
+        user_id, error = parse_user_id(raw)
+        if error:
+            results[index] = {'index': index, 'success': False, 'error': error}
+        else:
+            valid.append((index, user_id))
+    return valid, results
+
+@app.route(API_ENDPOINTS['check_balance_bulk'], methods=['POST'])
+def api_check_balance_bulk():
+    """API endpoint to check many balances at once"""
     try:
-        # Get bot username on startup
-        get_bot_username()
+        data = request.get_json()
         
-        # Start Flask app in a separate thread
-        flask_thread = threading.Thread(
-            target=lambda: app.run(
-                host='0.0.0.0', 
-                port=int(os.environ.get('PORT', 5000)), 
-                debug=False
-            ), 
-            daemon=True
-        )
-        flask_thread.start()
-        logger.info("Flask API server started")
+        # Validate API key
+        if data.get('api_key') != API_SECRET_KEY:
+            return jsonify({'error': 'Invalid API key'}), 401
+        
+        items, error = get_bulk_list(data, 'user_ids')
+        if error:
+            return jsonify({'error': error[0]}), error[1]
+        
+        valid, results = parse_bulk_user_ids(items)
+        balances = storage.get_balances([user_id for _, user_id in valid])
+        for index, user_id in valid:
+            results[index] = {'index': index, 'success': True, 'user_id': user_id, 'balance': balances[user_id]}
+        
+        return jsonify({
+            'success': True,
+            'results': results,
+            'timestamp': get_local_time()
+        })
+        
+    except Exception as e:
+        logger.error(f"API check_balance_bulk error: {e}")
+        return jsonify({'error': 'Internal server error'}), 500
+
+@app.route(API_ENDPOINTS['user_info_bulk'], methods=['POST'])
+def api_user_info_bulk():
+    """API endpoint to get information for many users at once"""
+    try:
+        data = request.get_json()
+        
+        # Validate API key
+        if data.get('api_key') != API_SECRET_KEY:
+            return jsonify({'error': 'Invalid API key'}), 401
+        
+        items, error = get_bulk_list(data, 'user_ids')
+        if error:
+            return jsonify({'error': error[0]}), error[1]
+        
+        valid, results = parse_bulk_user_ids(items)
+        summaries = storage.get_user_summaries([user_id for _, user_id in valid])
+        for index, user_id in valid:
+            results[index] = {'index': index, 'success': True, **build_user_info(user_id, summaries[user_id])}
+        
+        return jsonify({
+            'success': True,
+            'results': results,
+            'timestamp': get_local_time()
+        })
         
+    except Exception as e:
+        logger.error(f"API user_info_bulk error: {e}")
+        return jsonify({'error': 'Internal server error'}), 500
+
+@app.route(API_ENDPOINTS['withdrawals'], methods=['POST'])
+def api_withdrawals():
+    """API endpoint to page through withdrawals, oldest first"""
+    try:
+        data = request.get_json()
+
+        # Validate API key
+        if data.get('api_key') != API_SECRET_KEY:
+            return jsonify({'error': 'Invalid API key'}), 401
+
+        status = data.get('status', 'pending')
+        if status is not None and status not in WITHDRAWAL_STATUSES:
+            return jsonify({'error': f"status must be one of {', '.join(WITHDRAWAL_STATUSES)} or null"}), 400
+
+        user_id = None
+        if data.get('user_id') is not None:
+            user_id, error = parse_user_id(data.get('user_id'))
+            if error:
+                return jsonify({'error': error}), 400
+
+        try:
+            limit = int(data.get('limit', 100))
+        except (ValueError, TypeError):
+            return jsonify({'error': 'Invalid limit format'}), 400
+        if not 1 <= limit <= API_BULK_MAX_ITEMS:
+            return jsonify({'error': f'limit must be between 1 and {API_BULK_MAX_ITEMS}'}), 400
+
+        try:
+            items, next_cursor = storage.list_withdrawals(status, user_id, data.get('cursor'), limit)
+        except ValueError as e:
+            return jsonify({'error': str(e)}), 400
+
+        return jsonify({
+            'success': True,
+            'withdrawals': [{'request_id': request_id, **record} for request_id, record in items],
+            'next_cursor': next_cursor,
+            'total': storage.count_withdrawals(status, user_id),
+            'timestamp': get_local_time()
+        })
+
+    except Exception as e:
+        logger.error(f"API withdrawals error: {e}")
+        return jsonify({'error': 'Internal server error'}), 500
+
+@app.route(API_ENDPOINTS['withdrawals_process'], methods=['POST'])
+def api_withdrawals_process():
+    """API endpoint to approve or reject a batch of pending withdrawals"""
+    try:
+        data = request.get_json()
+
+        # Validate API key
+        if data.get('api_key') != API_SECRET_KEY:
+            return jsonify({'error': 'Invalid API key'}), 401
+
+        status = data.get('status')
+        if status not in ('approved', 'rejected'):
+            return jsonify({'error': 'status must be approved or rejected'}), 400
+
+        request_ids, error = get_bulk_list(data, 'request_ids')
+        if error:
+            return jsonify({'error': error[0]}), error[1]
+
+        results = []
+        for request_id in request_ids:
+            record = process_withdrawal_request(str(request_id), status)
+            if record is None:
+                results.append({'request_id': request_id, 'success': False, 'error': 'Not a pending withdrawal'})
+            else:
+                results.append({'request_id': request_id, 'success': True, 'status': record['status']})
+
+        return jsonify({
+            'success': True,
+            'processed': sum(1 for result in results if result['success']),
+            'results': results,
+            'pending': storage.count_withdrawals('pending'),
+            'timestamp': get_local_time()
+        })
+
+    except NotDurableError as e:
+        # Not acknowledged: the journal is failing, so the change may or may not survive a crash
+        logger.error(f"API withdrawals_process not durable: {e}")
+        return jsonify({'error': 'Change not saved, retry later'}), 503
+    except Exception as e:
+        logger.error(f"API withdrawals_process error: {e}")
+        return jsonify({'error': 'Internal server error'}), 500
+
+@app.route(API_ENDPOINTS['stats'], methods=['POST'])
+def api_stats():
+    """API endpoint to get platform statistics"""
+    try:
+        data = request.get_json()
+
+        # Validate API key
+        if data.get('api_key') != API_SECRET_KEY:
+            return jsonify({'error': 'Invalid API key'}), 401
+
+        # Counters kept by storage: no scan, safe to poll
+        return jsonify({
+            'success': True,
+            **get_platform_stats(),
+            'timestamp': get_local_time()
+        })
+
+    except Exception as e:
+        logger.error(f"API stats error: {e}")
+        return jsonify({'error': 'Internal server error'}), 500
+
+# ✅ RUN APPLICATION
+def run_http_server():
+    """Flask's built-in server; production API traffic goes through gunicorn (RUN_MODE=api)"""
+    app.run(host='0.0.0.0', port=int(os.environ.get('PORT', 5000)), debug=False, threaded=True)
+
+def run_bot():
+    """Run the bot update loop (and the API too when RUN_MODE=all)"""
+    # Get bot username on startup
+    get_bot_username()
+
+    # Pick up a broadcast interrupted by the last restart
+    resume_broadcast()
+    
+    if BOT_MODE == 'webhook':
+        # Updates arrive over HTTP, so the Flask server is the main loop
+        start_webhook()
+        logger.info("Starting Flask server in webhook mode...")
+        run_http_server()
+    else:
+        if RUN_MODE == 'all':
+            # Start Flask app in a separate thread
+            flask_thread = threading.Thread(target=run_http_server, daemon=True)
+            flask_thread.start()
+            logger.info("Flask API server started")
+
+        # Polling fails while a webhook is registered
+        bot.remove_webhook()
+
         # Start bot polling
-        logger.info("Starting bot polling...")
-        bot.infinity_polling(timeout=60, long_polling_timeout=60)
+        if BOT_RUNTIME == 'asyncio':
+            logger.info("Starting bot polling on the asyncio runtime...")
+            update_ingestor.run(get_updates=fetch_updates_async)
+        else:
+            logger.info("Starting bot polling...")
+            bot.infinity_polling(timeout=60, long_polling_timeout=60)
+
+if __name__ == "__main__":
+    try:
+        if RUN_MODE == 'api':
+            # Development only; production runs gunicorn against main:app
+            logger.warning("RUN_MODE=api should be served with: gunicorn -c gunicorn.conf.py main:app")
+            run_http_server()
+        else:
+            run_bot()
         
     except KeyboardInterrupt:
         logger.info("Bot stopped by user")
+        outbound.stop()
+        persistence.stop()
     except Exception as e:
         logger.error(f"Critical error: {e}")
         raise
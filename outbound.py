@@ -0,0 +1,408 @@
+"""
+Outbound Telegram message queue.
+
+Handlers enqueue messages and return immediately. Worker threads (or
+coroutines on an asyncio event loop, see ``run_async``) deliver them
+while respecting a global send rate and a per-chat rate, keep messages to
+one chat in order, honor ``retry_after`` from 429 responses and retry
+transient failures with backoff.
+"""
+
+import asyncio
+import contextlib
+import heapq
+import itertools
+import logging
+import threading
+import time
+from collections import deque
+
+logger = logging.getLogger(__name__)
+
+
+class TokenBucket:
+    """Classic token bucket; callers pass the current monotonic time"""
+
+    def __init__(self, rate, capacity, now=None):
+        self.rate = float(rate)
+        self.capacity = float(capacity)
+        self.tokens = float(capacity)
+        self.updated = time.monotonic() if now is None else now
+
+    def _refill(self, now):
+        if now > self.updated:
+            self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+
+    def delay(self, now):
+        """Seconds until a token is available (0 if one is available now)"""
+        self._refill(now)
+        if self.tokens >= 1:
+            return 0.0
+        return (1 - self.tokens) / self.rate
+
+    def consume(self, now):
+        """Take one token, returns False if none is available"""
+        self._refill(now)
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return True
+        return False
+
+    def full(self, now):
+        self._refill(now)
+        return self.tokens >= self.capacity
+
+
+class OutboundMessage:
+    """One queued API call"""
+
+    __slots__ = ('method', 'chat_id', 'args', 'kwargs', 'coalesce_key', 'attempts', 'enqueued_at')
+
+    def __init__(self, method, chat_id, args, kwargs, coalesce_key=None):
+        self.method = method
+        self.chat_id = chat_id
+        self.args = args
+        self.kwargs = kwargs
+        self.coalesce_key = coalesce_key
+        self.attempts = 0
+        self.enqueued_at = time.monotonic()
+
+
+class _ChatQueue:
+    """Pending messages and rate state for one chat"""
+
+    __slots__ = ('messages', 'bucket', 'blocked_until', 'scheduled', 'in_flight')
+
+    def __init__(self, bucket):
+        self.messages = deque()
+        self.bucket = bucket
+        self.blocked_until = 0.0
+        self.scheduled = False
+        self.in_flight = False
+
+
+class OutboundDispatcher:
+    """Rate-limited asynchronous sender.
+
+    ``send`` is called with an OutboundMessage and performs the API call.
+    ``classify_error`` maps an exception to ``(retry, retry_after)``.
+    """
+
+    def __init__(self, send, classify_error=None, global_rate=30.0, per_chat_rate=1.0,
+                 per_chat_burst=3, workers=8, max_retries=5, max_queue=100000):
+        self.send = send
+        self.classify_error = classify_error or (lambda e: (True, None))
+        self.global_rate = global_rate
+        self.per_chat_rate = per_chat_rate
+        self.per_chat_burst = per_chat_burst
+        self.workers = workers
+        self.max_retries = max_retries
+        self.max_queue = max_queue
+
+        self._cond = threading.Condition()
+        self._global_bucket = TokenBucket(global_rate, max(1.0, global_rate))
+        self._chats = {}
+        self._ready = []  # heap of (ready_at, seq, chat_id)
+        self._seq = itertools.count()
+        self._depth = 0
+        self._in_flight = 0
+        self._threads = []
+        self._stopping = False
+        self._finished = 0
+        # Wakes the asyncio consumer, set while run_async is running
+        self._wake_async = None
+        # Per-thread list collecting enqueue() calls, see holding()
+        self._local = threading.local()
+
+        self.sent = 0
+        self.failed = 0
+        self.retried = 0
+        self.coalesced = 0
+        self.dropped = 0
+        self.rate_limited = 0
+
+    # Producer side
+    def enqueue(self, method, chat_id, *args, coalesce_key=None, **kwargs):
+        """Queue an API call; returns False if the queue is full.
+
+        With a coalesce_key, a still-pending message with the same key for the
+        same chat is replaced instead of sending both.
+        """
+        held = getattr(self._local, 'held', None)
+        if held is not None:
+            held.append((method, chat_id, args, kwargs, coalesce_key))
+            return True
+
+        message = OutboundMessage(method, chat_id, args, kwargs, coalesce_key)
+        with self._cond:
+            chat = self._chats.get(chat_id)
+            if chat is None:
+                chat = self._chats[chat_id] = _ChatQueue(TokenBucket(self.per_chat_rate, self.per_chat_burst))
+
+            if coalesce_key is not None:
+                for i, pending in enumerate(chat.messages):
+                    if pending.coalesce_key == coalesce_key:
+                        chat.messages[i] = message
+                        self.coalesced += 1
+                        return True
+
+            if self._depth >= self.max_queue:
+                self.dropped += 1
+                logger.warning(f"Outbound queue full ({self._depth}), dropping message to {chat_id}")
+                return False
+
+            chat.messages.append(message)
+            self._depth += 1
+            self._schedule(chat_id, chat, time.monotonic())
+            self._notify()
+        return True
+
+    @contextlib.contextmanager
+    def holding(self, held):
+        """Collect this thread's enqueue() calls in held instead of queueing them.
+
+        The asyncio runtime holds a handler's replies this way until the
+        writes they acknowledge are durable, then passes them to release().
+        """
+        self._local.held = held
+        try:
+            yield held
+        finally:
+            self._local.held = None
+
+    def release(self, held):
+        """Queue the calls collected by holding(), in order"""
+        for method, chat_id, args, kwargs, coalesce_key in held:
+            self.enqueue(method, chat_id, *args, coalesce_key=coalesce_key, **kwargs)
+
+    def take_global_token(self):
+        """Charge one API call made outside the queue to the global rate.
+
+        Returns 0 once a token was taken, or the seconds to wait before
+        asking again, so callers with their own pacing (broadcasts) share
+        the bot-wide limit with queued messages.
+        """
+        with self._cond:
+            now = time.monotonic()
+            delay = self._global_bucket.delay(now)
+            if delay > 0:
+                return delay
+            self._global_bucket.consume(now)
+            return 0.0
+
+    def _notify(self, all_waiters=False):
+        """Wake consumers after the queue changed (hold _cond)"""
+        if all_waiters:
+            self._cond.notify_all()
+        else:
+            self._cond.notify()
+        if self._wake_async is not None:
+            self._wake_async()
+
+    def _schedule(self, chat_id, chat, now):
+        """Put a chat with pending messages on the ready heap (hold _cond)"""
+        if chat.scheduled or chat.in_flight or not chat.messages:
+            return
+        ready_at = max(now + chat.bucket.delay(now), chat.blocked_until)
+        heapq.heappush(self._ready, (ready_at, next(self._seq), chat_id))
+        chat.scheduled = True
+
+    # Consumer side
+    def start(self):
+        """Start the delivery threads"""
+        with self._cond:
+            if self._threads:
+                return
+            self._stopping = False
+            for i in range(self.workers):
+                thread = threading.Thread(target=self._run, name=f'outbound-{i}', daemon=True)
+                thread.start()
+                self._threads.append(thread)
+
+    def stop(self, timeout=5):
+        """Stop after draining what can be sent within timeout"""
+        self.flush(timeout)
+        with self._cond:
+            self._stopping = True
+            self._notify(all_waiters=True)
+        for thread in self._threads:
+            thread.join(timeout=1)
+        self._threads = []
+
+    def flush(self, timeout=None):
+        """Wait until the queue is empty and nothing is in flight"""
+        deadline = None if timeout is None else time.monotonic() + timeout
+        with self._cond:
+            while self._depth or self._in_flight:
+                remaining = None if deadline is None else deadline - time.monotonic()
+                if remaining is not None and remaining <= 0:
+                    return False
+                self._cond.wait(remaining if remaining is not None else 0.5)
+        return True
+
+    def _take(self):
+        """Pop a message that may be sent now under both rate limits (hold _cond).
+
+        Returns (message, None), or (None, seconds to wait) where None means
+        until something is enqueued.
+        """
+        while True:
+            if not self._ready:
+                return None, None
+
+            ready_at, _, chat_id = self._ready[0]
+            now = time.monotonic()
+            if ready_at > now:
+                return None, ready_at - now
+
+            global_delay = self._global_bucket.delay(now)
+            if global_delay > 0:
+                return None, global_delay
+
+            heapq.heappop(self._ready)
+            chat = self._chats[chat_id]
+            chat.scheduled = False
+            if not chat.bucket.consume(now):
+                self._schedule(chat_id, chat, now)
+                continue
+
+            self._global_bucket.consume(now)
+            message = chat.messages.popleft()
+            self._depth -= 1
+            self._in_flight += 1
+            chat.in_flight = True
+            return message, None
+
+    def _next_message(self):
+        """Block until a message may be sent under both rate limits"""
+        with self._cond:
+            while not self._stopping:
+                message, wait = self._take()
+                if message is not None:
+                    return message
+                self._cond.wait(wait)
+            return None
+
+    def _run(self):
+        while True:
+            message = self._next_message()
+            if message is None:
+                return
+            message.attempts += 1
+            try:
+                self.send(message)
+            except Exception as e:
+                self._finish(message, e)
+            else:
+                self._finish(message, None)
+
+    def _finish(self, message, error):
+        now = time.monotonic()
+        with self._cond:
+            chat = self._chats[message.chat_id]
+            chat.in_flight = False
+            self._in_flight -= 1
+
+            if error is None:
+                self.sent += 1
+            else:
+                retry, retry_after = self.classify_error(error)
+                if retry_after:
+                    self.rate_limited += 1
+                    chat.blocked_until = now + retry_after
+                if retry and message.attempts <= self.max_retries:
+                    if not retry_after:
+                        chat.blocked_until = now + min(30.0, 0.5 * 2 ** (message.attempts - 1))
+                    # Retry before anything else queued for this chat to keep order
+                    chat.messages.appendleft(message)
+                    self._depth += 1
+                    self.retried += 1
+                else:
+                    self.failed += 1
+                    logger.error(f"Dropping {message.method} to {message.chat_id} after "
+                                 f"{message.attempts} attempt(s): {error}")
+
+            if chat.messages:
+                self._schedule(message.chat_id, chat, now)
+            self._finished += 1
+            if self._finished % 1000 == 0:
+                self._prune(now)
+            self._notify(all_waiters=True)
+
+    async def run_async(self, send, concurrency=None):
+        """Deliver from the running event loop instead of threads.
+
+        ``send`` is a coroutine function taking an OutboundMessage. Up to
+        concurrency (default: workers) calls are in flight at once, each a
+        task on the loop rather than a thread. Runs until stop().
+        """
+        loop = asyncio.get_running_loop()
+        wakeup = asyncio.Event()
+        slots = asyncio.Semaphore(concurrency or self.workers)
+        tasks = set()
+
+        async def deliver(message):
+            try:
+                await send(message)
+            except Exception as e:
+                self._finish(message, e)
+            else:
+                self._finish(message, None)
+            finally:
+                slots.release()
+
+        with self._cond:
+            self._stopping = False
+            # enqueue() runs on handler threads, so wake the loop thread-safely
+            self._wake_async = lambda: loop.call_soon_threadsafe(wakeup.set)
+        try:
+            while True:
+                await slots.acquire()
+                while True:
+                    wakeup.clear()
+                    with self._cond:
+                        if self._stopping:
+                            slots.release()
+                            return
+                        message, wait = self._take()
+                    if message is not None:
+                        break
+                    try:
+                        await asyncio.wait_for(wakeup.wait(), wait)
+                    except asyncio.TimeoutError:
+                        pass
+                message.attempts += 1
+                task = loop.create_task(deliver(message))
+                tasks.add(task)
+                task.add_done_callback(tasks.discard)
+        finally:
+            with self._cond:
+                self._wake_async = None
+
+    def _prune(self, now):
+        """Forget idle chats whose rate state has fully recovered (hold _cond)"""
+        idle = [chat_id for chat_id, chat in self._chats.items()
+                if not chat.messages and not chat.in_flight
+                and chat.blocked_until <= now and chat.bucket.full(now)]
+        for chat_id in idle:
+            del self._chats[chat_id]
+
+    # Introspection
+    def queue_depth(self):
+        """Messages waiting to be sent (not counting in-flight ones)"""
+        return self._depth
+
+    def stats(self):
+        with self._cond:
+            return {
+                'queue_depth': self._depth,
+                'in_flight': self._in_flight,
+                'chats_pending': len(self._ready),
+                'sent': self.sent,
+                'failed': self.failed,
+                'retried': self.retried,
+                'coalesced': self.coalesced,
+                'dropped': self.dropped,
+                'rate_limited': self.rate_limited
+            }
@@ -0,0 +1,162 @@
+"""
+Background persistence.
+
+Handlers change state in memory and call ``request()``, which returns at
+once with a ticket. One worker thread runs the actual save, folding every
+request that arrives while a save is running, or within a short delay
+after the first one, into a single flush. Callers that must not answer
+before their change is on disk wait for their ticket (``wait``) or use
+``flush()``, which skips the delay. A save also runs every ``interval``
+seconds when nothing asked for one, and ``stop()`` writes a final
+compacted snapshot.
+
+Since every save goes through this one thread, two saves never run at
+the same time.
+"""
+
+import logging
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+
+class PersistenceWorker:
+    """Coalesces save requests onto one background thread.
+
+    ``save(compact)`` persists everything pending and returns True on
+    success. ``on_save(requests, lag, ok)`` is called after each save with
+    the number of requests it covered and the seconds since the oldest of
+    them was made.
+    """
+
+    def __init__(self, save, delay=0.2, interval=30.0, on_save=None, clock=time.monotonic):
+        self.save = save
+        self.delay = delay
+        self.interval = interval
+        self.on_save = on_save
+        self.clock = clock
+        self._cond = threading.Condition()
+        # Tickets: requested so far, covered by a finished save, covered by a successful one
+        self._requested = 0
+        self._done = 0
+        self._saved = 0
+        self._first_pending_at = None
+        self._compact = False
+        self._urgent = False
+        self._stopping = False
+        self._thread = None
+        self.saves = 0
+        self.failures = 0
+
+    def start(self):
+        with self._cond:
+            if self._thread is not None:
+                return
+            self._stopping = False
+            self._thread = threading.Thread(target=self._run, name='persistence', daemon=True)
+            self._thread.start()
+
+    def stop(self, timeout=30):
+        """Write a final compacted snapshot and stop the worker"""
+        thread = self._thread
+        if thread is None:
+            return self.save(True)
+        ticket = self.request(compact=True, urgent=True)
+        saved = self.wait(ticket, timeout)
+        with self._cond:
+            self._stopping = True
+            self._cond.notify_all()
+        thread.join(timeout)
+        self._thread = None
+        return saved
+
+    def request(self, compact=False, urgent=False):
+        """Ask for a save; returns a ticket for wait()"""
+        with self._cond:
+            self._requested += 1
+            if self._first_pending_at is None:
+                self._first_pending_at = self.clock()
+            self._compact = self._compact or compact
+            self._urgent = self._urgent or urgent
+            self._cond.notify_all()
+            return self._requested
+
+    def wait(self, ticket, timeout=None):
+        """Block until a save covering ticket finished; True if it succeeded"""
+        deadline = None if timeout is None else time.monotonic() + timeout
+        with self._cond:
+            while self._done < ticket:
+                remaining = None if deadline is None else deadline - time.monotonic()
+                if remaining is not None and remaining <= 0:
+                    return False
+                self._cond.wait(remaining)
+            return self._saved >= ticket
+
+    def flush(self, compact=False, timeout=30):
+        """Save now and wait until it is on disk"""
+        if self._thread is None:
+            return self.save(compact)
+        return self.wait(self.request(compact=compact, urgent=True), timeout)
+
+    def pending(self):
+        """Requests not yet covered by a finished save"""
+        with self._cond:
+            return self._requested - self._done
+
+    def _next_batch(self):
+        """Wait for work; returns (ticket, compact, first_pending_at) or None to stop"""
+        with self._cond:
+            periodic_at = self.clock() + self.interval
+            while self._requested == self._done and not self._stopping:
+                remaining = periodic_at - self.clock()
+                if remaining <= 0:
+                    # Nothing asked, but records may still be dirty (and the journal may need compacting)
+                    return self._requested, False, None
+                self._cond.wait(remaining)
+            if self._requested == self._done:
+                return None
+            if not self._urgent and self.delay > 0:
+                # Give requests of the same burst a moment to join this save
+                flush_at = self._first_pending_at + self.delay
+                while not self._urgent and not self._stopping and self.clock() < flush_at:
+                    self._cond.wait(flush_at - self.clock())
+            batch = (self._requested, self._compact, self._first_pending_at)
+            self._first_pending_at = None
+            self._compact = self._urgent = False
+            return batch
+
+    def _run(self):
+        while True:
+            batch = self._next_batch()
+            if batch is None:
+                return
+            ticket, compact, first_pending_at = batch
+            try:
+                ok = bool(self.save(compact))
+            except Exception as e:
+                logger.error(f"❌ Background save error: {e}")
+                ok = False
+            with self._cond:
+                covered = ticket - self._done
+                self._done = max(self._done, ticket)
+                if ok:
+                    self._saved = max(self._saved, ticket)
+                    self.saves += 1
+                else:
+                    self.failures += 1
+                self._cond.notify_all()
+            if self.on_save is not None and first_pending_at is not None:
+                self.on_save(covered, self.clock() - first_pending_at, ok)
+            if not ok:
+                # The changes stay dirty; retry with the next request or periodic save
+                logger.error("❌ Background save failed")
+
+    def stats(self):
+        with self._cond:
+            return {
+                'requests': self._requested,
+                'saves': self.saves,
+                'failures': self.failures,
+                'pending': self._requested - self._done
+            }
@@ -0,0 +1,116 @@
+#!/usr/bin/env python3
+"""
+Snapshot Tool
+Inspects and converts the JSON storage snapshot (bot_data.json plus the
+bot_data.users user segment). Stop the bot before converting: the bot
+holds the state in memory and would overwrite the result.
+
+Usage:
+    python snapshot_tool.py info
+    python snapshot_tool.py export state.json      # indented all-JSON copy, journal included
+    python snapshot_tool.py convert --format json  # in place, for older releases
+    python snapshot_tool.py convert --format binary --compression none
+"""
+
+import argparse
+import json
+import os
+import sys
+
+from storage import (SNAPSHOT_CODECS, SNAPSHOT_FORMATS, SNAPSHOT_MAGIC, JsonStorage,
+                     decode_snapshot, read_user_segment, user_segment_path)
+
+
+def open_storage(args, snapshot_format='binary', compression='zlib'):
+    """Load the snapshot and journal named by the command line"""
+    storage = JsonStorage(args.data_file, args.backup_file, args.journal_file,
+                          snapshot_format=snapshot_format, compression=compression)
+    storage.load()
+    return storage
+
+
+def describe_snapshot(path):
+    """One line about a snapshot file, raising when it does not verify"""
+    with open(path, 'rb') as f:
+        raw = f.read()
+    data = decode_snapshot(raw)
+    if raw.startswith(SNAPSHOT_MAGIC):
+        header = json.loads(raw[len(SNAPSHOT_MAGIC):raw.index(b'\n', len(SNAPSHOT_MAGIC))])
+        kind = (f"binary v{header['version']}, {header['codec']}, "
+                f"{header['raw_bytes']:,} bytes of JSON, checksum ok")
+    else:
+        kind = "plain JSON"
+    users = data.get('user_segment', {}).get('users', data.get('data_integrity_check'))
+    return f"{kind}, {len(raw):,} bytes, {users} users, saved {data.get('save_timestamp')}"
+
+
+def describe_segment(path):
+    """One line about a user segment, raising when it does not verify"""
+    _, header = read_user_segment(path)
+    checksum = ', checksum ok' if 'crc32' in header else ''
+    return (f"generation {header['generation']}, v{header['version']}, {header.get('codec', 'none')}{checksum}, "
+            f"{os.path.getsize(path):,} bytes, {header['users']} users")
+
+
+def info(args):
+    """Describe every snapshot file, returns False if any is unreadable"""
+    ok = True
+    for path, describe in ((args.data_file, describe_snapshot), (args.backup_file, describe_snapshot),
+                           (user_segment_path(args.data_file), describe_segment),
+                           (user_segment_path(args.backup_file), describe_segment)):
+        if not os.path.exists(path):
+            continue
+        try:
+            print(f"✅ {path}: {describe(path)}")
+        except Exception as e:
+            print(f"❌ {path}: {e}")
+            ok = False
+    if os.path.exists(args.journal_file):
+        print(f"📝 {args.journal_file}: {os.path.getsize(args.journal_file):,} bytes not yet compacted")
+    return ok
+
+
+def export(args):
+    """Write the full state as indented all-JSON to args.output"""
+    storage = open_storage(args)
+    with open(args.output, 'w', encoding='utf-8') as f:
+        json.dump(storage.export_state(), f, ensure_ascii=False, indent=2)
+    print(f"💾 {storage.user_count()} users written to {args.output}")
+    return True
+
+
+def convert(args):
+    """Rewrite the snapshot in place in another format, folding in the journal"""
+    storage = open_storage(args, args.format, args.compression)
+    if not storage.flush(compact=True):
+        print("❌ Conversion failed, see the log above")
+        return False
+    print(f"🔄 {args.data_file} rewritten as {args.format} ({storage.last_flush_bytes:,} bytes, "
+          f"{storage.user_count()} users)")
+    if args.format == 'json':
+        print("   bot_data.users is no longer used and can be deleted")
+    return True
+
+
+def main():
+    """Main tool function"""
+    parser = argparse.ArgumentParser(description="Inspect and convert JSON storage snapshots")
+    parser.add_argument('--data-file', default='bot_data.json', help="snapshot (default bot_data.json)")
+    parser.add_argument('--backup-file', default='bot_data_backup.json', help="backup snapshot (default bot_data_backup.json)")
+    parser.add_argument('--journal-file', default='bot_data.journal', help="delta journal (default bot_data.journal)")
+    commands = parser.add_subparsers(dest='command', required=True)
+    commands.add_parser('info', help="show format, size and checksum status of each file")
+    export_parser = commands.add_parser('export', help="write the state as indented all-JSON")
+    export_parser.add_argument('output', help="file to write")
+    convert_parser = commands.add_parser('convert', help="rewrite the snapshot in another format")
+    convert_parser.add_argument('--format', choices=SNAPSHOT_FORMATS, required=True)
+    convert_parser.add_argument('--compression', choices=SNAPSHOT_CODECS, default='zlib',
+                                help="for --format binary (default zlib)")
+    args = parser.parse_args()
+
+    ok = {'info': info, 'export': export, 'convert': convert}[args.command](args)
+    sys.exit(0 if ok else 1)
+
+
+if __name__ == "__main__":
+    main()
@@ -23,8 +23,14 @@ echo "API Secret Key: $(echo $API_SECRET_KEY | cut -c1-10)..."
 mkdir -p logs
 
 # Start the application
-echo "Starting main application..."
-python main.py
+# RUN_MODE=api serves only the HTTP API through gunicorn; bot/all run main.py
+if [ "$RUN_MODE" = "api" ]; then
+    echo "Starting API server (gunicorn)..."
+    gunicorn -c gunicorn.conf.py main:app
+else
+    echo "Starting main application (RUN_MODE=${RUN_MODE:-all})..."
+    python main.py
+fi
 
 # If main.py exits, log the reason
 echo "Application exited with code $?"
@@ -0,0 +1,102 @@
+"""
+Webhook update ingestion.
+
+The Flask webhook route hands each update to an UpdateIngestor, which
+drops updates it has already seen (Telegram redelivers on timeouts),
+puts new ones on a bounded queue and processes them on a fixed pool of
+worker threads. When the queue is full the route answers 503 so that
+Telegram backs off and redelivers later instead of us buffering without
+limit.
+"""
+
+import logging
+import queue
+import threading
+from collections import OrderedDict
+
+logger = logging.getLogger(__name__)
+
+ACCEPTED = 'accepted'
+DUPLICATE = 'duplicate'
+BUSY = 'busy'
+
+
+class UpdateIngestor:
+    """Bounded, deduplicating work queue for incoming updates"""
+
+    def __init__(self, process, workers=8, max_queue=1000, dedupe_size=10000):
+        self.process = process
+        self.workers = workers
+        self.max_queue = max_queue
+        self.dedupe_size = dedupe_size
+        self._queue = queue.Queue(maxsize=max_queue)
+        self._seen = OrderedDict()
+        self._lock = threading.Lock()
+        self._threads = []
+
+        self.accepted = 0
+        self.duplicates = 0
+        self.rejected = 0
+        self.processed = 0
+        self.errors = 0
+
+    def submit(self, update_id, payload):
+        """Queue an update unless it is a duplicate or the queue is full"""
+        with self._lock:
+            if update_id is not None and update_id in self._seen:
+                self.duplicates += 1
+                return DUPLICATE
+            try:
+                self._enqueue(payload)
+            except queue.Full:
+                # Not remembered as seen, so Telegram's redelivery is accepted later
+                self.rejected += 1
+                return BUSY
+            if update_id is not None:
+                self._seen[update_id] = True
+                if len(self._seen) > self.dedupe_size:
+                    self._seen.popitem(last=False)
+            self.accepted += 1
+        return ACCEPTED
+
+    def _enqueue(self, payload):
+        """Hand an update to the workers, raising queue.Full when there is no room (hold _lock)"""
+        self._queue.put_nowait(payload)
+
+    def start(self):
+        """Start the worker threads"""
+        if self._threads:
+            return
+        for i in range(self.workers):
+            thread = threading.Thread(target=self._run, name=f'webhook-{i}', daemon=True)
+            thread.start()
+            self._threads.append(thread)
+
+    def _run(self):
+        while True:
+            payload = self._queue.get()
+            try:
+                self.process(payload)
+                self.processed += 1
+            except Exception as e:
+                self.errors += 1
+                logger.error(f"Error processing update: {e}")
+            finally:
+                self._queue.task_done()
+
+    def join(self):
+        """Wait until every queued update is processed"""
+        self._queue.join()
+
+    def queue_depth(self):
+        return self._queue.qsize()
+
+    def stats(self):
+        return {
+            'queue_depth': self.queue_depth(),
+            'accepted': self.accepted,
+            'duplicates': self.duplicates,
+            'rejected': self.rejected,
+            'processed': self.processed,
+            'errors': self.errors
+        }
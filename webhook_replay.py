@@ -0,0 +1,99 @@
+#!/usr/bin/env python3
+"""
+Webhook Replay Script
+Posts recorded Telegram updates to the bot's webhook endpoint, standing in
+for Telegram when testing BOT_MODE=webhook locally.
+
+Accepts a file of updates as JSON lines, a JSON array, or a saved
+getUpdates response ({"ok": true, "result": [...]}).
+"""
+
+import argparse
+import json
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+
+import requests
+
+
+def load_updates(path):
+    """Load recorded updates from a file"""
+    with open(path, 'r', encoding='utf-8') as f:
+        content = f.read().strip()
+
+    if not content:
+        return []
+    if content[0] in '[{':
+        try:
+            data = json.loads(content)
+            if isinstance(data, dict):
+                return data.get('result', [data])
+            return data
+        except json.JSONDecodeError:
+            pass  # Fall through to JSON lines
+    return [json.loads(line) for line in content.splitlines() if line.strip()]
+
+
+def post_update(session, url, secret, update):
+    """POST one update the way Telegram does, returns (status, seconds)"""
+    headers = {'X-Telegram-Bot-Api-Secret-Token': secret} if secret else {}
+    start = time.perf_counter()
+    try:
+        response = session.post(url, json=update, headers=headers, timeout=10)
+        return response.status_code, time.perf_counter() - start
+    except requests.exceptions.RequestException:
+        return None, time.perf_counter() - start
+
+
+def main():
+    """Main replay function"""
+    parser = argparse.ArgumentParser(description="Replay recorded updates against a webhook endpoint")
+    parser.add_argument('base_url', help="e.g. http://localhost:5000")
+    parser.add_argument('updates_file', help="recorded updates (JSON lines or JSON array)")
+    parser.add_argument('--path', default='/webhook', help="webhook path (default /webhook)")
+    parser.add_argument('--secret', default='', help="WEBHOOK_SECRET of the bot (required in webhook mode)")
+    parser.add_argument('--concurrency', type=int, default=8, help="parallel connections (default 8)")
+    parser.add_argument('--repeat', type=int, default=1, help="send every update N times to exercise deduplication")
+    args = parser.parse_args()
+
+    updates = load_updates(args.updates_file)
+    if not updates:
+        print("❌ No updates found")
+        sys.exit(1)
+
+    url = args.base_url.rstrip('/') + args.path
+    batch = [u for u in updates for _ in range(args.repeat)]
+
+    print(f"🔁 Replaying {len(batch)} updates to {url}")
+    print(f"⏰ Time: {datetime.now().strftime('%Y-%m-%d %H:%M:%S')}")
+    print("-" * 50)
+
+    session = requests.Session()
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=args.concurrency) as pool:
+        results = list(pool.map(lambda u: post_update(session, url, args.secret, u), batch))
+    elapsed = time.perf_counter() - start
+
+    statuses = {}
+    for status, _ in results:
+        statuses[status] = statuses.get(status, 0) + 1
+    latencies = sorted(seconds for _, seconds in results)
+
+    print(f"Status codes: {statuses}")
+    print(f"Throughput: {len(batch) / elapsed:.1f} updates/s")
+    print(f"Latency p50: {latencies[len(latencies) // 2] * 1000:.1f} ms, "
+          f"p99: {latencies[min(len(latencies) - 1, int(len(latencies) * 0.99))] * 1000:.1f} ms")
+    print("-" * 50)
+
+    if statuses.get(200, 0) == len(batch):
+        print("🎉 All updates accepted!")
+        sys.exit(0)
+    else:
+        print("💥 Some updates were rejected (503 means backpressure)")
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()